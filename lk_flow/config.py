@@ -22,6 +22,29 @@ class Config:
     sentry_dns = None
     # 配置文件
     sleep_time = 5
+    max_concurrency = 16  # 批量启停任务时的最大并发数
+    # 子进程启动方式 asyncio | posix_spawn 任务可在extra_json中覆盖
+    spawn_backend = "asyncio"
+    # 子进程日志 任务可在extra_json中覆盖
+    # pipe 经daemon写入 | direct 子进程直接写入日志文件 不支持转发与轮转
+    log_mode = "pipe"
+    log_mirror = True  # 是否将子进程输出转发到系统日志
+    log_buffer_size = 64 * 1024  # 日志缓冲超过该字节数时写入文件
+    log_flush_interval = 1.0  # 日志缓冲最长保留秒数
+    log_read_size = 64 * 1024  # 每次从管道读取的最大字节数
+    log_queue_size = 4 * 1024 * 1024  # 每个日志文件等待写线程写入的最大字节数
+    log_overflow = "block"  # 写入队列已满时的处理策略 block | drop_oldest | drop_newest
+    log_max_bytes = 0  # 日志文件超过该字节数时轮转 0为不轮转
+    log_max_age = 0  # 日志文件开始写入超过该秒数时轮转 0为不轮转
+    log_backup_count = 5  # 保留的轮转文件数
+    log_compress = False  # 是否gzip压缩轮转文件
+    log_format = "raw"  # raw 原样写入 | json 每行一条带时间戳的记录 支持按时间范围查询
+    log_index_interval = 10  # json格式日志的时间索引间隔 秒 0为不建索引
+    log_tail_size = 64 * 1024  # 内存中保留的最近输出字节数 stdout与stderr各一份
+    # 事件循环延迟监控
+    loop_monitor_interval = 0.5  # 采样间隔 秒 0为关闭
+    loop_lag_threshold = 1.0  # 延迟超过该秒数时发送LOOP_LAG事件 0为不发送
+    slow_callback_duration = 0  # 大于0时记录耗时超过该秒数的回调
     # mod config
     mod_dir: str = None
     mod_config: Dict[str, Dict[str, Any]] = defaultdict(dict)
@@ -7,7 +7,17 @@
 是 config env errors 的下游逻辑
 """
 from lk_flow.core.context import Context
-from lk_flow.core.event import EVENT, Event, EventBus
+from lk_flow.core.event import (
+    EVENT,
+    Event,
+    EventBus,
+    HeartbeatEvent,
+    LoopLagEvent,
+    OverflowPolicy,
+    SystemEvent,
+    TaskEvent,
+)
+from lk_flow.core.loop_monitor import LoopMonitor
 from lk_flow.core.mod import (
     ModAbstraction,
     loading_plugin,
@@ -26,7 +36,13 @@ __all__ = [
     # event stuff
     EVENT,
     Event,
+    HeartbeatEvent,
+    TaskEvent,
+    SystemEvent,
+    LoopLagEvent,
     EventBus,
+    OverflowPolicy,
+    LoopMonitor,
     # all Context
     Context,
 ]
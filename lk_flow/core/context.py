@@ -7,16 +7,38 @@ from __future__ import annotations
 import asyncio
 import datetime
 import traceback
-from typing import TYPE_CHECKING, Dict, ItemsView, Optional, Type
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Awaitable,
+    Callable,
+    Coroutine,
+    Dict,
+    ItemsView,
+    Iterable,
+    Optional,
+    Set,
+    Type,
+    Union,
+)
 
 from lk_flow.config import Config
-from lk_flow.core.event import EVENT, Event, EventBus
+from lk_flow.core.event import (
+    EVENT,
+    Event,
+    EventBus,
+    HeartbeatEvent,
+    SystemEvent,
+    TaskEvent,
+)
+from lk_flow.core.loop_monitor import LoopMonitor
 from lk_flow.env import logger
 from lk_flow.errors import (
     DuplicateModError,
     DuplicateTaskNameError,
     LkFlowBaseError,
     ModNotFoundError,
+    RunningError,
     TaskNotFoundError,
 )
 from lk_flow.models import SubProcess, Task
@@ -36,14 +58,25 @@ class Context:
         self.event_bus: EventBus = EventBus()
         self.sleep_time: int = config.sleep_time
         self.system_start_time: datetime.datetime = datetime.datetime.now()
+        self.heartbeat_lag: float = 0.0  # 最近一次心跳晚于计划时间的秒数
+        self.loop_monitor: LoopMonitor = LoopMonitor(
+            self.event_bus,
+            interval=config.loop_monitor_interval,
+            lag_threshold=config.loop_lag_threshold,
+            slow_callback_duration=config.slow_callback_duration,
+        )
         # Process 集合
         self._PROCESS_ALL = {}  # 所有Task
         self._PROCESS_RUNNING = {}  # 正在跑的
         self._PROCESS_STOPPED = {}  # 未激活 or 已结束的
         self._mod_map: Dict[str, Type["ModAbstraction"]] = {}
+        # entry_loop 提前唤醒用 见 wakeup_at
+        self._next_wakeup: Optional[datetime.datetime] = None
+        self._wakeup_event: Optional[asyncio.Event] = None
+        # run_coroutine 创建的后台任务 保持引用避免被回收
+        self._background_tasks: Set[asyncio.Task] = set()
         # add add_listener
         self.event_bus.add_listener(EVENT.EXEC_SYSTEM_CLOSE, self._close_loop)
-        self.event_bus.add_listener(EVENT.HEARTBEAT, self.state_check)
 
     @classmethod
     def get_instance(cls) -> Context:
@@ -99,18 +132,27 @@ class Context:
 
     # Task
 
-    def start_task(self, task_name: str) -> None:
+    async def start_task_async(self, task_name: str) -> None:
+        """启动进程"""
         if task_name in self._PROCESS_RUNNING:
             return
+        self.get_process(task_name)  # check task exists
         # get subprocess
         process_manager: SubProcess = self._PROCESS_STOPPED.pop(task_name)
         # pre start
-        self.event_bus.publish_event(Event(EVENT.TASK_PRE_START, task_name=task_name))
-        # start
-        asyncio.get_event_loop().run_until_complete(process_manager.start())
+        self.event_bus.publish_event(
+            TaskEvent(EVENT.TASK_PRE_START, task_name=task_name)
+        )
+        # 先登记为运行中 进程启动后立即退出时 退出回调也能完成状态切换
         self._PROCESS_RUNNING[task_name] = process_manager
+        try:
+            await process_manager.start()
+        except Exception:
+            self._PROCESS_RUNNING.pop(task_name, None)
+            self._PROCESS_STOPPED[task_name] = process_manager
+            raise
         # running
-        event = Event(
+        event = TaskEvent(
             EVENT.TASK_RUNNING,
             task_name=task_name,
             task=process_manager.config,
@@ -118,16 +160,16 @@ class Context:
         )
         self.event_bus.publish_event(event)
 
-    def stop_task(self, task_name: str) -> None:
+    async def stop_task_async(self, task_name: str) -> None:
         """停止进程"""
         if task_name not in self._PROCESS_RUNNING:
             return
         process_manager: SubProcess = self._PROCESS_RUNNING.pop(task_name)
         # stop
-        asyncio.get_event_loop().run_until_complete(process_manager.stop())
+        await process_manager.stop()
         self._PROCESS_STOPPED[task_name] = process_manager
         # running
-        event = Event(
+        event = TaskEvent(
             EVENT.TASK_STOP,
             task_name=task_name,
             task=process_manager.config,
@@ -135,6 +177,124 @@ class Context:
         )
         self.event_bus.publish_event(event)
 
+    async def delete_task_async(self, task_name: str) -> None:
+        """从系统中删除任务 运行中的进程会先被停止"""
+        subprocess: SubProcess = self._PROCESS_ALL.pop(task_name, None)
+        if subprocess is None:
+            return
+        if self._PROCESS_RUNNING.pop(task_name, None):
+            await subprocess.stop()
+        else:
+            self._PROCESS_STOPPED.pop(task_name, None)
+        event = TaskEvent(
+            EVENT.TASK_DELETE,
+            task_name=task_name,
+            task=subprocess.config,
+            process=subprocess,
+        )
+        self.event_bus.publish_event(event)
+
+    async def start_tasks_async(
+        self, task_names: Iterable[str], max_concurrency: int = None
+    ) -> Dict[str, Optional[BaseException]]:
+        """
+        并发启动多个任务 同时进行的启动数不超过max_concurrency
+
+        Returns:
+            {task_name: None | 启动时抛出的异常}
+        """
+        return await self._gather_bounded(
+            self.start_task_async, task_names, max_concurrency
+        )
+
+    async def stop_tasks_async(
+        self, task_names: Iterable[str], max_concurrency: int = None
+    ) -> Dict[str, Optional[BaseException]]:
+        """并发停止多个任务 同时进行的停止数不超过max_concurrency"""
+        return await self._gather_bounded(
+            self.stop_task_async, task_names, max_concurrency
+        )
+
+    async def _gather_bounded(
+        self,
+        func: Callable[[str], Awaitable[None]],
+        task_names: Iterable[str],
+        max_concurrency: Optional[int],
+    ) -> Dict[str, Optional[BaseException]]:
+        task_names = list(dict.fromkeys(task_names))  # 去重并保持顺序
+        if max_concurrency is None:
+            max_concurrency = self.config.max_concurrency
+        if max_concurrency <= 0:
+            raise RunningError(f"max_concurrency必须大于0 当前为{max_concurrency}")
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def _bounded(task_name: str) -> None:
+            async with semaphore:
+                await func(task_name)
+
+        results = await asyncio.gather(
+            *(_bounded(task_name) for task_name in task_names),
+            return_exceptions=True,
+        )
+        for task_name, result in zip(task_names, results):
+            if result is not None and not isinstance(result, LkFlowBaseError):
+                logger.error(f"{func.__name__}({task_name}) error {result!r}")
+        return dict(zip(task_names, results))
+
+    def start_task(self, task_name: str) -> None:
+        """start_task_async 的同步版本 兼容旧接口"""
+        asyncio.get_event_loop().run_until_complete(self.start_task_async(task_name))
+
+    def stop_task(self, task_name: str) -> None:
+        """stop_task_async 的同步版本 兼容旧接口"""
+        asyncio.get_event_loop().run_until_complete(self.stop_task_async(task_name))
+
+    def delete_task(self, task_name: str) -> None:
+        """delete_task_async 的同步版本 兼容旧接口"""
+        asyncio.get_event_loop().run_until_complete(self.delete_task_async(task_name))
+
+    def start_tasks(
+        self, task_names: Iterable[str], max_concurrency: int = None
+    ) -> Dict[str, Optional[BaseException]]:
+        """start_tasks_async 的同步版本"""
+        return asyncio.get_event_loop().run_until_complete(
+            self.start_tasks_async(task_names, max_concurrency)
+        )
+
+    def stop_tasks(
+        self, task_names: Iterable[str], max_concurrency: int = None
+    ) -> Dict[str, Optional[BaseException]]:
+        """stop_tasks_async 的同步版本"""
+        return asyncio.get_event_loop().run_until_complete(
+            self.stop_tasks_async(task_names, max_concurrency)
+        )
+
+    def run_coroutine(self, coro: Coroutine) -> Union[asyncio.Task, Any]:
+        """
+        供同步的事件监听函数调用async接口
+        事件循环运行中则创建后台任务并发执行 否则阻塞运行至结束
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.get_event_loop().run_until_complete(coro)
+        task = loop.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_task_done)
+        return task
+
+    def _background_task_done(self, task: asyncio.Task) -> None:
+        self._background_tasks.discard(task)
+        if task.cancelled():
+            return
+        err = task.exception()
+        if err is not None and not isinstance(err, LkFlowBaseError):
+            # LkFlowBaseError 创建时已记录日志
+            logger.error(f"background task error {err!r}")
+            logger.error(
+                "".join(traceback.format_exception(type(err), err, err.__traceback__))
+            )
+
     def add_task(self, task: Task) -> Optional[SubProcess]:
         """添加任务到系统"""
         if task.name in self._PROCESS_ALL:  # 已加载
@@ -142,41 +302,27 @@ class Context:
             raise DuplicateTaskNameError(message)
 
         logger.debug(f"add task: {task}")
-        process_manager = SubProcess(task)
+        process_manager = SubProcess(task, exit_callback=self._on_process_exit)
         self._PROCESS_ALL[task.name] = process_manager
         self._PROCESS_STOPPED[task.name] = process_manager
 
-        event = Event(
+        event = TaskEvent(
             EVENT.TASK_ADD, task_name=task.name, task=task, process=process_manager
         )
         self.event_bus.publish_event(event)
         return process_manager
 
-    def delete_task(self, task_name: str) -> None:
-        subprocess: SubProcess = self._PROCESS_ALL.pop(task_name, None)
-        if subprocess is None:
-            return
-        if self._PROCESS_RUNNING.pop(task_name, None):
-            asyncio.run(subprocess.stop())
-        else:
-            self._PROCESS_STOPPED.pop(task_name, None)
-        event = Event(
-            EVENT.TASK_DELETE,
-            task_name=task_name,
-            task=subprocess.config,
-            process=subprocess,
-        )
-        self.event_bus.publish_event(event)
-
     # System
 
     def _close_loop(self, event: Event) -> Optional[True]:
         """关闭循环"""
         self.loop_enable = False
+        if self._wakeup_event is not None:
+            self._wakeup_event.set()
         for task_name in self._PROCESS_RUNNING.copy().keys():
             self.stop_task(task_name)
         logger.info(f"Get {event}, close loop.")
-        self.event_bus.publish_event(Event(EVENT.SYSTEM_CLOSE))
+        self.event_bus.publish_event(SystemEvent(EVENT.SYSTEM_CLOSE))
 
     def is_running(self, task_name: str) -> bool:
         """check is running"""
@@ -184,27 +330,78 @@ class Context:
             return True
         return False
 
-    def state_check(self, _: Event) -> None:
+    def _on_process_exit(self, process: SubProcess) -> None:
         """
-        检查进程状态
+        进程退出回调 由 SubProcess._process_watcher 在进程结束时直接调用
         进程正常退出则发送 TASK_FINISH事件
         异常退出发送 TASK_RUNNING_ERROR事件
         """
-        for name, subprocess in self._PROCESS_RUNNING.copy().items():
-            if subprocess.exit_code is None:
-                # still running
-                continue
+        name = process.name
+        if self._PROCESS_RUNNING.get(name) is process:
             self._PROCESS_RUNNING.pop(name)
-            self._PROCESS_STOPPED[name] = subprocess
+            self._PROCESS_STOPPED[name] = process
+        if process.exit_code == 0:
+            self.event_bus.publish_event(TaskEvent(EVENT.TASK_FINISH, task_name=name))
+        else:
+            self.event_bus.publish_event(
+                TaskEvent(EVENT.TASK_RUNNING_ERROR, task_name=name)
+            )
+
+    def wakeup_at(self, when: datetime.datetime) -> None:
+        """
+        请求entry_loop在when时刻发送HEARTBEAT
+        早于下一次sleep_time心跳时 entry_loop会提前醒来
+        """
+        if self._next_wakeup is not None and self._next_wakeup <= when:
+            return
+        self._next_wakeup = when
+        if self._wakeup_event is not None:
+            self._wakeup_event.set()
+
+    async def _wait_next_heartbeat(
+        self, last_heartbeat: datetime.datetime
+    ) -> Optional[datetime.datetime]:
+        """睡眠至 sleep_time 或 wakeup_at 请求的时间 取较早者 返回计划唤醒时间"""
+        deadline = last_heartbeat + datetime.timedelta(seconds=self.sleep_time)
+        while self.loop_enable:
+            self._wakeup_event.clear()
+            now = datetime.datetime.now()
+            if self._next_wakeup is not None and self._next_wakeup <= now:
+                wake_time, self._next_wakeup = self._next_wakeup, None
+                # 唤醒时间已过 也要让出一次事件循环 避免心跳空转
+                await asyncio.sleep(0)
+                return wake_time
+            wake_time = deadline
+            if self._next_wakeup is not None and self._next_wakeup < deadline:
+                wake_time = self._next_wakeup
+            timeout = (wake_time - now).total_seconds()
+            if timeout <= 0:
+                await asyncio.sleep(0)
+                return wake_time
+            try:
+                await asyncio.wait_for(self._wakeup_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                continue
+        return None
 
     async def entry_loop(self) -> None:
+        self._wakeup_event = asyncio.Event()
+        self.loop_monitor.start()
+        try:
+            await self._heartbeat_loop()
+        finally:
+            self.loop_monitor.stop()
+
+    async def _heartbeat_loop(self) -> None:
+        wake_time = None
         while self.loop_enable:
+            now = datetime.datetime.now()
+            if wake_time is not None:
+                self.heartbeat_lag = max((now - wake_time).total_seconds(), 0.0)
             try:
-                self.event_bus.publish_event(
-                    Event(EVENT.HEARTBEAT, now=datetime.datetime.now())
-                )
+                self.event_bus.publish_event(HeartbeatEvent(EVENT.HEARTBEAT, now=now))
             except LkFlowBaseError as err:
                 logger.error(err.message)
                 logger.error(traceback.format_exc())
-            await asyncio.sleep(self.sleep_time)
+            wake_time = await self._wait_next_heartbeat(now)
         return
@@ -2,13 +2,29 @@
 # encoding: utf-8
 # Created by zza on 2021/6/16 11:12
 # Copyright 2021 LinkSense Technology CO,. Ltd
+import asyncio
+import datetime
 import logging
+import time
+import traceback
 from collections import defaultdict
 from enum import Enum
-from typing import Any, Callable, Dict, List
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 from lk_flow.env import logger
-from lk_flow.utils import time_consuming_log
+from lk_flow.utils import Histogram, OverflowPolicy, time_consuming_log
 
 
 class EVENT(Enum):
@@ -24,6 +40,8 @@ class EVENT(Enum):
     SYSTEM_CLOSE = "system_close"
     # 系统关闭
     SYSTEM_TEARDOWN = "system_teardown"
+    # 事件循环延迟超过阈值
+    LOOP_LAG = "loop_lag"
 
     # Task CRUD
     TASK_ADD = "task_add"
@@ -40,34 +58,436 @@ class EVENT(Enum):
 
 
 class Event(object):
+    """
+    事件基类
+    Event(EVENT.X, **kwargs) 按事件类型返回带 __slots__ 的子类实例
+    含有子类未定义的参数时退回到 DictEvent
+
+    >>> Event(EVENT.HEARTBEAT, now=None)
+    HeartbeatEvent(EVENT.HEARTBEAT, now=None)
+    >>> Event(EVENT.HEARTBEAT, now=None, extra=1)
+    DictEvent(EVENT.HEARTBEAT, now=None, extra=1)
+    """
+
+    __slots__ = ("event_type",)
+    _fields: Tuple[str, ...] = ()
+    _field_set: frozenset = frozenset()
+
+    def __new__(cls, event_type: EVENT, **kwargs: Any) -> "Event":
+        if cls is Event:
+            cls = _EVENT_CLASSES.get(event_type, DictEvent)
+            if not kwargs.keys() <= cls._field_set:
+                cls = DictEvent
+        return object.__new__(cls)
+
     def __init__(self, event_type: EVENT, **kwargs: Any):
-        self.__dict__: Dict[str:Any] = kwargs
         self.event_type = event_type
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    def _items(self) -> Iterable[Tuple[str, Any]]:
+        return ((_field, getattr(self, _field)) for _field in self._fields)
 
     def __repr__(self) -> str:
-        _attr = ", ".join(
-            "{}={}".format(k, repr(v))
-            for k, v in self.__dict__.items()
-            if k != "event_type"
+        _attr = "".join(", {}={}".format(k, repr(v)) for k, v in self._items())
+        return f"{type(self).__name__}({self.event_type}{_attr})"
+
+    if TYPE_CHECKING:  # for typing check 允许访问任意事件属性
+
+        def __getattr__(self, item: str) -> Any:
+            raise AttributeError(item)
+
+
+class SystemEvent(Event):
+    """系统事件 无附加属性"""
+
+    __slots__ = ()
+
+    def __init__(self, event_type: EVENT):
+        self.event_type = event_type
+
+
+class HeartbeatEvent(Event):
+    """心跳事件"""
+
+    __slots__ = ("now",)
+    _fields = __slots__
+    _field_set = frozenset(_fields)
+
+    def __init__(self, event_type: EVENT, now: Optional[datetime.datetime] = None):
+        self.event_type = event_type
+        self.now = now
+
+
+class TaskEvent(Event):
+    """任务事件 task 与 process 在 TASK_PRE_START 等事件中可能为 None"""
+
+    __slots__ = ("task_name", "task", "process")
+    _fields = __slots__
+    _field_set = frozenset(_fields)
+
+    def __init__(
+        self,
+        event_type: EVENT,
+        task_name: Optional[str] = None,
+        task: Any = None,
+        process: Any = None,
+    ):
+        self.event_type = event_type
+        self.task_name = task_name
+        self.task = task
+        self.process = process
+
+
+class LoopLagEvent(Event):
+    """事件循环延迟事件 callback 为采样间隔内记录到的慢回调"""
+
+    __slots__ = ("lag", "callback")
+    _fields = __slots__
+    _field_set = frozenset(_fields)
+
+    def __init__(self, event_type: EVENT, lag: float = 0.0, callback: str = None):
+        self.event_type = event_type
+        self.lag = lag
+        self.callback = callback
+
+
+class DictEvent(Event):
+    """属性保存在 __dict__ 中 兼容自定义参数"""
+
+    def _items(self) -> Iterable[Tuple[str, Any]]:
+        return self.__dict__.items()
+
+
+_EVENT_CLASSES: Dict[EVENT, type] = {
+    EVENT.SYSTEM_SETUP: SystemEvent,
+    EVENT.HEARTBEAT: HeartbeatEvent,
+    EVENT.EXEC_SYSTEM_CLOSE: SystemEvent,
+    EVENT.SYSTEM_CLOSE: SystemEvent,
+    EVENT.SYSTEM_TEARDOWN: SystemEvent,
+    EVENT.LOOP_LAG: LoopLagEvent,
+    EVENT.TASK_ADD: TaskEvent,
+    EVENT.TASK_DELETE: TaskEvent,
+    EVENT.TASK_PRE_START: TaskEvent,
+    EVENT.TASK_RUNNING: TaskEvent,
+    EVENT.TASK_STOP: TaskEvent,
+    EVENT.TASK_FINISH: TaskEvent,
+    EVENT.TASK_RUNNING_ERROR: TaskEvent,
+    EVENT.TASK_FINISH_ERROR: TaskEvent,
+}
+
+
+class ListenerProxy(object):
+    """
+    包装 async 监听器 或配置了队列/超时的监听器
+    publish_event 中 async 监听器作为后台任务运行 不阻塞发布者
+    queue_size>0 时事件进入独立的有界队列 由后台worker按序处理
+    block策略在同步发布时无法等待 队列满后同步监听器直接处理
+    async 监听器另起后台任务 同时运行的任务数不超过queue_size 超出时丢弃新事件
+    timeout 限制 async 监听器的运行时间 同步监听器只记录超时日志
+    """
+
+    def __init__(
+        self,
+        listener: Callable,
+        queue_size: int = 0,
+        overflow: Union[OverflowPolicy, str] = OverflowPolicy.drop_newest,
+        timeout: Optional[float] = None,
+    ):
+        self.listener = listener
+        self.name = getattr(listener, "__qualname__", repr(listener))
+        self.is_coroutine = asyncio.iscoroutinefunction(listener)
+        self.queue_size = queue_size
+        self.overflow = OverflowPolicy(overflow)
+        self.timeout = timeout
+        self.dropped = 0  # 队列已满丢弃的事件数
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    def __call__(self, event: "Event") -> Optional[bool]:
+        """publish_event 同步发布"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:  # 无运行中的事件循环 阻塞处理
+            if self.is_coroutine:
+                return asyncio.get_event_loop().run_until_complete(self.invoke(event))
+            return self._call_sync(event)
+        if self.queue_size > 0 and self._put_nowait(loop, event):
+            return None
+        if self.is_coroutine:
+            if 0 < self.queue_size <= len(self._tasks):  # 队列已满的溢出任务同样有界
+                self._drop()
+                return None
+            task = loop.create_task(self.invoke(event))
+            self._tasks.add(task)
+            task.add_done_callback(self._task_done)
+            return None
+        return self._call_sync(event)
+
+    async def dispatch(self, event: "Event") -> Optional[bool]:
+        """publish_event_async 异步发布 未使用队列时等待监听器完成"""
+        if self.queue_size <= 0:
+            return await self.invoke(event)
+        loop = asyncio.get_running_loop()
+        if not self._put_nowait(loop, event):
+            await self._queue.put(event)  # block策略 等待队列空位
+        return None
+
+    async def invoke(self, event: "Event") -> Optional[bool]:
+        """运行监听器 async 监听器超时后取消"""
+        if not self.is_coroutine:
+            return self._call_sync(event)
+        try:
+            return await asyncio.wait_for(self.listener(event), self.timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"[EventBus] listener {self.name} timeout after {self.timeout}s "
+                f"on {event.event_type}"
+            )
+            return None
+
+    def qsize(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def close(self) -> None:
+        """取消worker与未完成的后台任务"""
+        if self._loop is not None and not self._loop.is_closed():
+            if self._worker is not None:
+                self._worker.cancel()
+            for task in self._tasks:
+                task.cancel()
+        self._tasks.clear()
+        self._worker = self._queue = self._loop = None
+
+    def _call_sync(self, event: "Event") -> Optional[bool]:
+        start_time = time.monotonic()
+        ret = self.listener(event)
+        used_time = time.monotonic() - start_time
+        if self.timeout is not None and used_time > self.timeout:
+            logger.warning(
+                f"[EventBus] listener {self.name} took {used_time:.3f}s "
+                f"on {event.event_type} (timeout {self.timeout}s)"
+            )
+        return ret
+
+    def _put_nowait(self, loop: asyncio.AbstractEventLoop, event: "Event") -> bool:
+        """放入队列 返回False表示block策略下队列已满 需由调用方处理"""
+        if self._loop is not loop:  # 队列与worker绑定到当前事件循环
+            self.close()
+            self._loop = loop
+            self._queue = asyncio.Queue(maxsize=self.queue_size)
+            self._worker = loop.create_task(self._consume())
+        queue = self._queue
+        if not queue.full():
+            queue.put_nowait(event)
+            return True
+        if self.overflow is OverflowPolicy.block:
+            return False
+        if self.overflow is OverflowPolicy.drop_oldest:
+            queue.get_nowait()
+            queue.task_done()
+            queue.put_nowait(event)
+        self._drop()
+        return True
+
+    def _drop(self) -> None:
+        self.dropped += 1
+        if self.dropped & (self.dropped - 1) == 0:  # 按2的幂次记录 避免刷屏
+            logger.warning(
+                f"[EventBus] listener {self.name} queue full, "
+                f"{self.dropped} events dropped ({self.overflow.value})"
+            )
+
+    async def _consume(self) -> None:
+        queue = self._queue
+        while True:
+            event = await queue.get()
+            try:
+                await self.invoke(event)
+            except Exception as err:
+                self._log_error(err)
+            finally:
+                queue.task_done()
+
+    def _task_done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self._log_error(task.exception())
+
+    def _log_error(self, err: BaseException) -> None:
+        logger.error(f"[EventBus] listener {self.name} error {err!r}")
+        logger.error(
+            "".join(traceback.format_exception(type(err), err, err.__traceback__))
         )
-        return f"Event({self.event_type}, {_attr})"
 
-    def __getattribute__(self, *args, **kwargs) -> Any:  # for typing check
-        return super(Event, self).__getattribute__(*args, **kwargs)
+
+_NO_LISTENERS: Tuple[Optional[Histogram], tuple] = (None, ())
 
 
 class EventBus(object):
+    """
+    事件总线
+    监听器按事件类型预编译为不可变元组 仅在增删监听器时重建 发布时直接遍历
+    每个(事件类型, 监听器)的耗时记录在固定大小的 Histogram 中 单位纳秒
+    ListenerProxy 记录的是发布方的耗时(入队或创建任务)
+    """
+
     def __init__(self):
         self._listeners: Dict[EVENT, List[Callable]] = defaultdict(list)
+        # {event_type: (事件总耗时, ((监听器, 监听器耗时), ...))}
+        self._dispatch: Dict[EVENT, Tuple[Histogram, tuple]] = {}
+        # DEBUG日志下使用 首次发布时包装耗时日志 增删监听器时失效
+        self._debug_dispatch: Dict[EVENT, Tuple[Histogram, tuple]] = {}
+        self.publish_histograms: Dict[EVENT, Histogram] = {}
+        # 与 _listeners 一一对应 按注册的监听器记录 移除时一并删除
+        self._listener_histograms: Dict[EVENT, List[Histogram]] = defaultdict(list)
 
-    def add_listener(self, event_type: EVENT, listener: Callable) -> None:
+    def add_listener(
+        self,
+        event_type: EVENT,
+        listener: Callable,
+        queue_size: int = 0,
+        overflow: Union[OverflowPolicy, str] = OverflowPolicy.drop_newest,
+        timeout: Optional[float] = None,
+    ) -> None:
+        """
+        注册监听器
+        async 监听器 或指定了 queue_size/timeout 时使用 ListenerProxy 包装 普通监听器直接调用
+        """
+        if asyncio.iscoroutinefunction(listener) or queue_size > 0 or timeout:
+            listener = ListenerProxy(listener, queue_size, overflow, timeout)
         self._listeners[event_type].append(listener)
+        self._listener_histograms[event_type].append(Histogram())
+        self._compile(event_type)
+
+    def remove_listener(self, event_type: EVENT, listener: Callable) -> None:
+        """移除监听器 未注册时忽略"""
+        listeners = self._listeners.get(event_type, [])
+        for index, _listener in enumerate(listeners):
+            if getattr(_listener, "listener", _listener) == listener:
+                del listeners[index]
+                del self._listener_histograms[event_type][index]
+                if isinstance(_listener, ListenerProxy):
+                    _listener.close()
+                self._compile(event_type)
+                return
+
+    def _compile(self, event_type: EVENT) -> None:
+        listeners = tuple(self._listeners[event_type])
+        event_stats = self.publish_histograms.setdefault(event_type, Histogram())
+        listener_stats = tuple(self._listener_histograms[event_type])
+        self._dispatch[event_type] = (
+            event_stats,
+            tuple(zip(listeners, listener_stats)),
+        )
+        # DEBUG日志下的监听链在首次使用时构建
+        self._debug_dispatch.pop(event_type, None)
+
+    def _compile_debug(self, event_type: EVENT) -> Tuple[Histogram, tuple]:
+        event_stats, dispatch = self._dispatch[event_type]
+        self._debug_dispatch[event_type] = (
+            event_stats,
+            tuple(
+                (
+                    (
+                        _listener
+                        if isinstance(_listener, ListenerProxy)
+                        else time_consuming_log(logging.DEBUG)(_listener)
+                    ),
+                    listener_stats,
+                )
+                for _listener, listener_stats in dispatch
+            ),
+        )
+        return self._debug_dispatch[event_type]
+
+    def _get_dispatch(self, event: Event) -> Tuple[Optional[Histogram], tuple]:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Get %s", event)
+            dispatch = self._debug_dispatch.get(event.event_type)
+            if dispatch is None and event.event_type in self._dispatch:
+                dispatch = self._compile_debug(event.event_type)
+            return dispatch or _NO_LISTENERS
+        return self._dispatch.get(event.event_type, _NO_LISTENERS)
 
     def publish_event(self, event: Event) -> None:
-        logger.debug(f"Get {event}")
-        for listener in self._listeners[event.event_type]:
-            if logger.level == logging.DEBUG:
-                listener = time_consuming_log(logging.DEBUG)(listener)
+        event_stats, listeners = self._get_dispatch(event)
+        if not listeners:
+            return
+        start_time = begin_time = time.perf_counter_ns()
+        for listener, listener_stats in listeners:
+            ret = listener(event)
+            end_time = time.perf_counter_ns()
+            listener_stats.observe(end_time - start_time)
+            start_time = end_time
             # 如果返回 True ，那么消息不再传递下去
-            if listener(event):
+            if ret:
                 break
+        event_stats.observe(start_time - begin_time)
+
+    async def publish_event_async(self, event: Event) -> None:
+        """
+        异步发布 按序等待未使用队列的 async 监听器完成
+        block策略的队列监听器在队列满时等待空位
+        """
+        event_stats, listeners = self._get_dispatch(event)
+        if not listeners:
+            return
+        start_time = begin_time = time.perf_counter_ns()
+        for listener, listener_stats in listeners:
+            if isinstance(listener, ListenerProxy):
+                ret = await listener.dispatch(event)
+            else:
+                ret = listener(event)
+            end_time = time.perf_counter_ns()
+            listener_stats.observe(end_time - start_time)
+            start_time = end_time
+            if ret:
+                break
+        event_stats.observe(start_time - begin_time)
+
+    def queue_depth(self) -> int:
+        """所有监听器队列中待处理的事件数"""
+        return sum(
+            _listener.qsize()
+            for listeners in self._listeners.values()
+            for _listener in listeners
+            if isinstance(_listener, ListenerProxy)
+        )
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        事件耗时统计 单位纳秒
+        {event_type: {"publish": {...}, "listeners": {listener_name: {...}}}}
+        """
+        stats = {
+            event_type.value: {"publish": histogram.to_dict(), "listeners": {}}
+            for event_type, histogram in self.publish_histograms.items()
+        }
+        for event_type, name, histogram in self.iter_listener_histograms():
+            stats[event_type.value]["listeners"][name] = histogram.to_dict()
+        return stats
+
+    def iter_listener_histograms(self) -> Iterator[Tuple[EVENT, str, Histogram]]:
+        """
+        (事件类型, 监听器名称, 耗时) 名称仅用于显示
+        同一事件类型下重名的监听器(如lambda 同类的不同实例)追加序号区分
+        """
+        for event_type, listeners in self._listeners.items():
+            seen: Dict[str, int] = {}
+            histograms = self._listener_histograms[event_type]
+            for _listener, histogram in zip(listeners, histograms):
+                name = listener_name(_listener)
+                seen[name] = seen.get(name, 0) + 1
+                if seen[name] > 1:
+                    name = f"{name}#{seen[name]}"
+                yield event_type, name, histogram
+
+
+def listener_name(listener: Callable) -> str:
+    """监听器名称 用于统计"""
+    if isinstance(listener, ListenerProxy):
+        return listener.name
+    return getattr(listener, "__qualname__", None) or repr(listener)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# encoding: utf-8
+# Created by agent on 2026/10/18 16:24
+# Copyright 2021 LinkSense Technology CO,. Ltd
+"""
+事件循环延迟监控
+按固定间隔用 loop.call_at 计划采样 实际执行时间与计划时间之差即为延迟
+嵌套的 run_until_complete 或阻塞的插件代码都会推迟采样 从而被记录
+nest_asyncio 替换了 _run_once 不再输出 asyncio debug 模式的慢回调日志
+因此慢回调通过计时 asyncio.Handle._run 检测
+"""
+import asyncio
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+from lk_flow.core.event import EVENT, EventBus, LoopLagEvent
+from lk_flow.env import logger
+from lk_flow.utils import Histogram
+
+# 正在检测慢回调的监控器 与被替换的 Handle._run
+_slow_callback_monitor: Optional["LoopMonitor"] = None
+_handle_run: Optional[Callable[[asyncio.Handle], None]] = None
+
+
+def _timed_handle_run(handle: asyncio.Handle) -> None:
+    start_time = time.perf_counter()
+    try:
+        _handle_run(handle)
+    finally:
+        used_time = time.perf_counter() - start_time
+        monitor = _slow_callback_monitor
+        if monitor is not None and used_time >= monitor.slow_callback_duration:
+            monitor.add_slow_callback(handle, used_time)
+
+
+def _callback_name(handle: asyncio.Handle) -> str:
+    """回调名称 Task 的回调显示其协程名"""
+    callback = handle._callback
+    owner = getattr(callback, "__self__", None)
+    if isinstance(owner, asyncio.Task):
+        coro = owner.get_coro()
+        return f"Task {getattr(coro, '__qualname__', repr(coro))}"
+    return getattr(callback, "__qualname__", None) or repr(callback)
+
+
+class LoopMonitor(object):
+    """
+    采样结果保存在固定长度的环形缓冲区中
+    slow_callback_duration>0 时记录执行过慢的回调名称
+    延迟超过 lag_threshold 时发送 EVENT.LOOP_LAG 事件
+    """
+
+    history_size: int = 256
+
+    def __init__(
+        self,
+        event_bus: EventBus,
+        interval: float = 0.5,
+        lag_threshold: float = 0.0,
+        slow_callback_duration: float = 0.0,
+    ):
+        self.event_bus = event_bus
+        self.interval = interval
+        self.lag_threshold = lag_threshold
+        self.slow_callback_duration = slow_callback_duration
+        # (采样时间戳, 延迟秒)
+        self.samples: Deque[Tuple[float, float]] = deque(maxlen=self.history_size)
+        # (时间戳, 回调, 耗时秒)
+        self.slow_callbacks: Deque[Tuple[float, str, float]] = deque(
+            maxlen=self.history_size
+        )
+        self.histogram = Histogram()  # 延迟 纳秒
+        self.last_lag: float = 0.0
+        self.slow_callback_count: int = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._handle: Optional[asyncio.TimerHandle] = None
+        self._expected: float = 0.0
+
+    def start(self) -> None:
+        """在运行中的事件循环上开始采样"""
+        global _slow_callback_monitor, _handle_run
+        if self.interval <= 0 or self._handle is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        if self.slow_callback_duration > 0:
+            if _handle_run is None:
+                _handle_run = asyncio.Handle._run
+                asyncio.Handle._run = _timed_handle_run
+            _slow_callback_monitor = self
+        self._schedule(self._loop.time())
+
+    def stop(self) -> None:
+        global _slow_callback_monitor, _handle_run
+        if self._handle is None:
+            return
+        self._handle.cancel()
+        self._handle = None
+        if _slow_callback_monitor is self:
+            _slow_callback_monitor = None
+            asyncio.Handle._run = _handle_run
+            _handle_run = None
+
+    def _schedule(self, now: float) -> None:
+        self._expected = now + self.interval
+        self._handle = self._loop.call_at(self._expected, self._sample)
+
+    def _sample(self) -> None:
+        now = self._loop.time()
+        lag = max(now - self._expected, 0.0)
+        self.last_lag = lag
+        self.samples.append((time.time(), lag))
+        self.histogram.observe(int(lag * 1e9))
+        self._schedule(now)
+        if 0 < self.lag_threshold <= lag:
+            callback = self._recent_slow_callback(lag)
+            logger.warning(
+                f"[LoopMonitor] event loop lag {lag:.3f}s"
+                + (f", slow callback {callback}" if callback else "")
+            )
+            self.event_bus.publish_event(
+                LoopLagEvent(EVENT.LOOP_LAG, lag=lag, callback=callback)
+            )
+
+    def _recent_slow_callback(self, lag: float) -> Optional[str]:
+        """本次采样间隔内记录到的慢回调"""
+        if not self.slow_callbacks:
+            return None
+        timestamp, callback, _ = self.slow_callbacks[-1]
+        if time.time() - timestamp > self.interval + lag:
+            return None
+        return callback
+
+    def add_slow_callback(self, handle: asyncio.Handle, used_time: float) -> None:
+        self.slow_callback_count += 1
+        self.slow_callbacks.append((time.time(), _callback_name(handle), used_time))
+
+    def get_stats(self, n: int = 60) -> Dict[str, Any]:
+        """最近n次采样与慢回调 延迟单位秒"""
+        return {
+            "interval": self.interval,
+            "last_lag": self.last_lag,
+            "lag": {
+                k: v if k == "count" else v / 1e9
+                for k, v in self.histogram.to_dict().items()
+            },
+            "samples": list(self.samples)[-n:] if n > 0 else [],
+            "slow_callback_count": self.slow_callback_count,
+            "slow_callbacks": list(self.slow_callbacks)[-n:] if n > 0 else [],
+        }
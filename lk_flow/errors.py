@@ -37,6 +37,10 @@ class ProcessRuntimeError(LkFlowBaseError):
     """子进程运行错误"""
 
 
+class LogTypeError(LkFlowBaseError, KeyError):
+    """日志类型错误"""
+
+
 class DuplicateModError(LkFlowBaseError, KeyError):
     """mod名称重复"""
 
@@ -0,0 +1,531 @@
+#!/usr/bin/env python
+# encoding: utf-8
+# Created by agent on 2026/10/18 16:27
+# Copyright 2021 LinkSense Technology CO,. Ltd
+"""
+子进程日志写入
+从管道按块读取的输出先在事件循环中合并 超过 buffer_size 或 flush_interval 后放入有界队列
+文件的打开 写入 轮转与关闭都在后台写线程中完成 磁盘延迟不影响事件循环
+轮转后的文件命名为 {path}.{时间戳} 压缩在独立线程中进行
+LogTail 在内存中保留最近的输出 供HTTP接口查看与跟踪
+json格式的日志旁有 {path}.idx 时间索引 按时间范围查询时二分查找起始偏移量 不扫描整个文件
+"""
+import asyncio
+import contextlib
+import datetime
+import gzip
+import json
+import os
+import re
+import shutil
+import struct
+import threading
+import time
+from collections import deque
+from typing import AsyncIterator, BinaryIO, Deque, Dict, List, Optional, Tuple, Union
+
+from lk_flow.env import logger
+from lk_flow.utils import OverflowPolicy
+
+_Waiter = Tuple[asyncio.AbstractEventLoop, asyncio.Future]
+_INDEX_ENTRY = struct.Struct("<dQ")  # 时间索引 (时间戳, 文件偏移量)
+# {日志路径: 开始写入的时间} 任务每次启动都新建LogFileBuffer 按路径保留 仅在写线程中使用
+_created_times: Dict[str, float] = {}
+_BACKUP_SUFFIX = re.compile(r"^\d{8}-\d{6}-\d{6}(\.gz)?$")
+
+
+def _wake(waiter: Optional[_Waiter]) -> None:
+    """在写线程中唤醒事件循环上等待的协程"""
+    if waiter is None:
+        return
+    loop, future = waiter
+    try:
+        loop.call_soon_threadsafe(_set_result, future)
+    except RuntimeError:  # 事件循环已关闭
+        pass
+
+
+def _set_result(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class LogWriter(object):
+    """后台写线程 所有日志文件共用 首次使用时启动"""
+
+    def __init__(self):
+        self._ready: Deque["LogFileBuffer"] = deque()
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def schedule(self, log_file: "LogFileBuffer") -> None:
+        with self._cond:
+            self._ready.append(log_file)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="lk_flow_log_writer", daemon=True
+                )
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._ready:
+                    self._cond.wait()
+                log_file = self._ready.popleft()
+            try:
+                log_file._drain()
+            except Exception as err:  # pragma: no cover
+                logger.error(f"[LogWriter] {log_file.path} error {err!r}")
+
+
+log_writer = LogWriter()
+
+
+class LogFileBuffer(object):
+    """
+    合并写入的日志文件
+    队列超过 max_queue_size 字节时按 overflow 处理
+    block 时 write 等待写线程腾出空位 不再读取管道 由子进程承受背压
+    文件超过 max_bytes 字节或开始写入超过 max_age 秒后 在下次写入前轮转
+    保留最近 backup_count 个轮转文件 compress 为真时压缩为gzip
+
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), "out.log")
+    >>> async def _write():
+    ...     log_file = LogFileBuffer(path, buffer_size=8, flush_interval=0)
+    ...     await log_file.write(b"abc")
+    ...     await log_file.write(b"defghi")
+    ...     log_file.close()
+    ...     await log_file.wait_closed()
+    >>> asyncio.run(_write())
+    >>> open(path, "rb").read()
+    b'abcdefghi'
+    """
+
+    def __init__(
+        self,
+        path: str,
+        buffer_size: int = 64 * 1024,
+        flush_interval: float = 1.0,
+        max_queue_size: int = 4 * 1024 * 1024,
+        overflow: Union[OverflowPolicy, str] = OverflowPolicy.block,
+        max_bytes: int = 0,
+        max_age: float = 0,
+        backup_count: int = 5,
+        compress: bool = False,
+        index_interval: float = 0,
+    ):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self.overflow = OverflowPolicy(overflow)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.backup_count = backup_count
+        self.compress = compress
+        self.index_interval = index_interval
+        self.dropped = 0  # 队列已满丢弃的字节数
+        # 事件循环中合并的数据
+        self._chunks: List[bytes] = []
+        self._size = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # 与写线程共享 由 _lock 保护
+        self._lock = threading.Lock()
+        self._queue: Deque[bytes] = deque()
+        self._queued = 0
+        self._scheduled = False
+        self._closing = False
+        self._closed = False
+        self._write_waiter: Optional[_Waiter] = None
+        self._close_waiter: Optional[_Waiter] = None
+        # 仅在写线程中使用
+        self._file: Optional[BinaryIO] = None
+        self._file_size = 0
+        self._created_at = 0.0
+        self._index: Optional[BinaryIO] = None
+        self._indexed_at = 0.0
+
+    async def write(self, data: bytes) -> None:
+        self._chunks.append(data)
+        self._size += len(data)
+        if self._size >= self.buffer_size:
+            await self.flush()
+        elif self._timer is None and self.flush_interval > 0:
+            # 输出稀疏时 由定时器保证数据在flush_interval内交给写线程
+            self._timer = asyncio.get_running_loop().call_later(
+                self.flush_interval, self._flush_nowait
+            )
+
+    async def flush(self) -> None:
+        """交给写线程 block策略下等待队列空位"""
+        self._cancel_timer()
+        while self._chunks and not self._submit():
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            with self._lock:
+                if self._has_room():
+                    continue
+                self._write_waiter = (loop, future)
+            await future
+
+    def close(self) -> None:
+        """提交剩余数据 写线程写完后关闭文件"""
+        self._cancel_timer()
+        if self._chunks:
+            self._submit(force=True)
+        with self._lock:
+            if self._closing:
+                return
+            self._closing = True
+            schedule = not self._scheduled
+            self._scheduled = True
+        if schedule:
+            log_writer.schedule(self)
+        if self.dropped:
+            logger.warning(
+                f"[LogWriter] {self.path} {self.dropped} bytes dropped "
+                f"({self.overflow.value})"
+            )
+
+    async def wait_closed(self) -> None:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            if self._closed:
+                return
+            self._close_waiter = (loop, future)
+        await future
+
+    def _cancel_timer(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _flush_nowait(self) -> None:
+        self._timer = None
+        if self._chunks and not self._submit():  # 队列已满 稍后重试
+            self._timer = asyncio.get_running_loop().call_later(
+                self.flush_interval, self._flush_nowait
+            )
+
+    def _has_room(self) -> bool:
+        return self._queued == 0 or self._queued + self._size <= self.max_queue_size
+
+    def _submit(self, force: bool = False) -> bool:
+        """放入队列 返回False表示block策略下队列已满"""
+        with self._lock:
+            if not self._has_room() and not force:
+                if self.overflow is OverflowPolicy.block:
+                    return False
+                dropped = self._size
+                if self.overflow is OverflowPolicy.drop_oldest:
+                    dropped = 0
+                    while self._queue and not self._has_room():
+                        data = self._queue.popleft()
+                        self._queued -= len(data)
+                        dropped += len(data)
+                self.dropped += dropped
+                if self.overflow is OverflowPolicy.drop_newest:
+                    self._chunks.clear()
+                    self._size = 0
+                    return True
+            data = b"".join(self._chunks)
+            self._chunks.clear()
+            self._size = 0
+            self._queue.append(data)
+            self._queued += len(data)
+            schedule = not self._scheduled
+            self._scheduled = True
+        if schedule:
+            log_writer.schedule(self)
+        return True
+
+    def _drain(self) -> None:
+        """在写线程中写出队列中的数据"""
+        while True:
+            with self._lock:
+                if not self._queue:
+                    self._scheduled = False
+                    closing = self._closing
+                    break
+                data = b"".join(self._queue)
+                self._queue.clear()
+                self._queued = 0
+                waiter, self._write_waiter = self._write_waiter, None
+            _wake(waiter)
+            self._write(data)
+        if closing:
+            if self._file is None:  # 子进程没有输出 同样创建日志文件
+                self._write(b"")
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self._close_index()
+            with self._lock:
+                self._closed = True
+                waiter, self._close_waiter = self._close_waiter, None
+            _wake(waiter)
+
+    def _write(self, data: bytes) -> None:
+        try:
+            if self._file is None:
+                self._open()
+            if self._file_size > 0 and self._should_rotate(len(data)):
+                self._rotate()
+                self._open()
+            if self.index_interval > 0 and data:
+                self._update_index()
+            self._file.write(data)
+            self._file.flush()
+            self._file_size += len(data)
+        except OSError as err:
+            logger.error(f"[LogWriter] write {self.path} error {err!r}")
+
+    def _open(self) -> None:
+        self._file = open(self.path, "ab")
+        self._file_size = self._file.tell()
+        self._created_at = _file_created_at(self.path, self._file)
+
+    def _should_rotate(self, size: int) -> bool:
+        if 0 < self.max_bytes < self._file_size + size:
+            return True
+        return 0 < self.max_age <= time.time() - self._created_at
+
+    def _update_index(self) -> None:
+        """每隔index_interval秒 在写入前记录 (当前时间, 文件偏移量)"""
+        now = time.time()
+        if now - self._indexed_at < self.index_interval:
+            return
+        if self._index is None:
+            # 新建的日志文件 清空残留的索引
+            self._index = open(self.path + ".idx", "ab" if self._file_size else "wb")
+        self._index.write(_INDEX_ENTRY.pack(now, self._file_size))
+        self._index.flush()
+        self._indexed_at = now
+
+    def _close_index(self) -> None:
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+        self._indexed_at = 0.0
+
+    def _rotate(self) -> None:
+        self._file.close()
+        self._file = None
+        _created_times.pop(self.path, None)
+        if self._index is not None:  # 索引只对应当前文件
+            self._close_index()
+            with contextlib.suppress(FileNotFoundError):  # 索引可能已被外部删除
+                os.remove(self.path + ".idx")
+        timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        backup = f"{self.path}.{timestamp}"
+        os.rename(self.path, backup)
+        if self.compress:
+            threading.Thread(
+                target=self._compress,
+                args=(backup,),
+                name="lk_flow_log_compress",
+                daemon=True,
+            ).start()
+        else:
+            self._remove_backups()
+
+    def _compress(self, backup: str) -> None:
+        """在压缩线程中执行 压缩完成后删除原文件"""
+        try:
+            with open(backup, "rb") as src, gzip.open(backup + ".tmp", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.replace(backup + ".tmp", backup + ".gz")
+            os.remove(backup)
+        except OSError as err:
+            logger.error(f"[LogWriter] compress {backup} error {err!r}")
+        finally:
+            self._remove_backups()
+
+    def _remove_backups(self) -> None:
+        """按时间戳删除超出 backup_count 的轮转文件"""
+        dir_name, base_name = os.path.split(self.path)
+        prefix = base_name + "."
+        try:
+            backups = [
+                name[len(prefix) :]
+                for name in os.listdir(dir_name)
+                if name.startswith(prefix) and _BACKUP_SUFFIX.match(name[len(prefix) :])
+            ]
+        except OSError:
+            return
+        # 压缩完成前 同一时间戳可能同时存在原文件与.gz文件
+        timestamps = sorted({suffix[:22] for suffix in backups})
+        expired = set(timestamps[: max(len(timestamps) - self.backup_count, 0)])
+        for suffix in backups:
+            if suffix[:22] in expired:
+                try:
+                    os.remove(os.path.join(dir_name, prefix + suffix))
+                except OSError:  # 已被其他线程删除或压缩
+                    pass
+
+
+def _file_created_at(path: str, file: BinaryIO) -> float:
+    """
+    日志文件开始写入的时间 用于max_age轮转
+    空文件从当前时间开始 daemon首次打开已有文件时以stat为准(不支持创建时间时为修改时间)
+    """
+    stat = os.fstat(file.fileno())
+    if stat.st_size == 0:
+        _created_times[path] = time.time()
+    elif path not in _created_times:
+        _created_times[path] = getattr(stat, "st_birthtime", stat.st_mtime)
+    return _created_times[path]
+
+
+def find_offset(path: str, timestamp: float) -> int:
+    """
+    在时间索引中二分查找 返回时间不晚于timestamp的最后一个索引项的偏移量
+    该偏移量之前的记录都早于timestamp
+    """
+    try:
+        with open(path + ".idx", "rb") as f:
+            low, high = 0, os.fstat(f.fileno()).st_size // _INDEX_ENTRY.size
+            offset = 0
+            while low < high:
+                middle = (low + high) // 2
+                f.seek(middle * _INDEX_ENTRY.size)
+                entry_time, entry_offset = _INDEX_ENTRY.unpack(
+                    f.read(_INDEX_ENTRY.size)
+                )
+                if entry_time <= timestamp:
+                    offset = entry_offset
+                    low = middle + 1
+                else:
+                    high = middle
+            return offset
+    except FileNotFoundError:
+        return 0
+
+
+def read_records(
+    path: str,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    limit: int = 1000,
+) -> Tuple[List[bytes], int]:
+    """
+    读取json格式日志中 since <= time <= until 的记录 最多limit条
+    返回 (记录行, 下一条未返回记录的文件偏移量)
+    """
+    records: List[bytes] = []
+    offset = find_offset(path, since) if since is not None else 0
+    if not os.path.exists(path):
+        return records, offset
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            try:
+                record_time = json.loads(line)["time"]
+            except (ValueError, KeyError, TypeError):  # 不完整或非json的行
+                offset += len(line)
+                continue
+            if until is not None and record_time > until:
+                break
+            offset += len(line)
+            if since is not None and record_time < since:
+                continue
+            records.append(line)
+            if len(records) >= limit:
+                break
+    return records, offset
+
+
+class LogTail(object):
+    """
+    最近输出的环形缓冲 按块保存 总大小约为 max_size 字节
+    end 为累计写入的字节数 用作增量读取的偏移量
+
+    >>> tail = LogTail(max_size=8)
+    >>> tail.append(b"line1\\nline2\\n")
+    >>> tail.append(b"line3\\nline4")
+    >>> tail.tail(2)
+    b'line3\\nline4'
+    >>> tail.since(12), tail.end
+    (b'line3\\nline4', 23)
+    >>> tail.tail(10)  # 超出max_size的旧数据已丢弃
+    b'line3\\nline4'
+    """
+
+    def __init__(self, max_size: int = 64 * 1024):
+        self.max_size = max_size
+        self.end = 0
+        self._chunks: Deque[bytes] = deque()
+        self._size = 0
+        self._waiter: Optional[asyncio.Future] = None
+
+    @property
+    def start(self) -> int:
+        """缓冲中最早数据的偏移量"""
+        return self.end - self._size
+
+    def append(self, data: bytes) -> None:
+        self._chunks.append(data)
+        self._size += len(data)
+        self.end += len(data)
+        while self._chunks and self._size - len(self._chunks[0]) >= self.max_size:
+            self._size -= len(self._chunks.popleft())
+        if self._waiter is not None:
+            _set_result(self._waiter)
+            self._waiter = None
+
+    def tail(self, n: int) -> bytes:
+        """最后n行 只遍历所需的块"""
+        if n <= 0:
+            return b""
+        parts: List[bytes] = []
+        lines = 0
+        for chunk in reversed(self._chunks):
+            parts.append(chunk)
+            # 末尾的换行不计入
+            lines += chunk.count(b"\n", 0, len(chunk) - 1 if len(parts) == 1 else None)
+            if lines >= n:
+                break
+        data = b"".join(reversed(parts))
+        index = len(data) - 1
+        for _ in range(n):
+            index = data.rfind(b"\n", 0, index)
+            if index < 0:
+                return data
+        return data[index + 1 :]
+
+    def since(self, offset: int) -> bytes:
+        """偏移量offset之后的数据 已被丢弃的部分不返回"""
+        if offset >= self.end:
+            return b""
+        parts: List[bytes] = []
+        position = self.end
+        for chunk in reversed(self._chunks):
+            parts.append(chunk)
+            position -= len(chunk)
+            if position <= offset:
+                break
+        data = b"".join(reversed(parts))
+        return data[max(offset - position, 0) :]
+
+    async def wait(self, offset: int) -> None:
+        """等待偏移量offset之后的新数据"""
+        while self.end <= offset:
+            if self._waiter is None:
+                self._waiter = asyncio.get_running_loop().create_future()
+            await asyncio.shield(self._waiter)
+
+    async def follow(self, n: int = 20) -> AsyncIterator[bytes]:
+        """先返回最后n行 之后持续返回新数据"""
+        data = self.tail(n)
+        offset = self.end
+        if data:
+            yield data
+        while True:
+            await self.wait(offset)
+            data = self.since(offset)
+            offset = self.end
+            yield data
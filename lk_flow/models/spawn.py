@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# encoding: utf-8
+# Created by agent on 2026/10/18 16:50
+# Copyright 2021 LinkSense Technology CO,. Ltd
+"""
+基于 os.posix_spawn 的子进程启动
+glibc 的 posix_spawn 使用 vfork 语义 不复制父进程页表 daemon内存较大时启动开销仍然稳定
+进程退出通过 pidfd (Linux 5.3+, Python 3.9+) 在事件循环中等待 否则由等待线程回收
+"""
+import asyncio
+import os
+import signal
+import threading
+from typing import Dict, List, Optional, Union
+
+from lk_flow.env import logger
+
+PIPE = asyncio.subprocess.PIPE
+
+# posix_spawn 需要 Python 3.8+
+available: bool = hasattr(os, "posix_spawn")
+
+
+def _exit_code(status: int) -> int:
+    """与 asyncio.subprocess.Process.returncode 一致 被信号结束时为负的信号值"""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class SpawnedProcess(object):
+    """posix_spawn 启动的进程 提供 SubProcess 使用的 asyncio Process 接口"""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.returncode: Optional[int] = None
+        self.stdout: Optional[asyncio.StreamReader] = None
+        self.stderr: Optional[asyncio.StreamReader] = None
+        self._exited: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    async def wait(self) -> int:
+        return await asyncio.shield(self._exited)
+
+    def send_signal(self, sig: int) -> None:
+        if self.returncode is None:
+            os.kill(self.pid, sig)
+
+    def terminate(self) -> None:
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self) -> None:
+        self.send_signal(signal.SIGKILL)
+
+    def _reap(self) -> int:
+        """回收子进程 返回退出码 进程已被其他地方回收时退出码未知 返回-1"""
+        try:
+            _, status = os.waitpid(self.pid, 0)
+        except ChildProcessError:
+            logger.warning(f"[spawn] {self.pid} 已被回收 退出码未知")
+            return -1
+        return _exit_code(status)
+
+    def _set_returncode(self, returncode: int) -> None:
+        self.returncode = returncode
+        if not self._exited.done():
+            self._exited.set_result(self.returncode)
+
+    def _watch(self, loop: asyncio.AbstractEventLoop) -> None:
+        try:
+            pidfd = os.pidfd_open(self.pid)
+        except (AttributeError, OSError):  # 不支持pidfd 由线程阻塞等待
+            threading.Thread(
+                target=self._wait_thread,
+                args=(loop,),
+                name=f"lk_flow_waitpid_{self.pid}",
+                daemon=True,
+            ).start()
+            return
+
+        def _on_exit() -> None:
+            loop.remove_reader(pidfd)
+            os.close(pidfd)
+            self._set_returncode(self._reap())
+
+        loop.add_reader(pidfd, _on_exit)
+
+    def _wait_thread(self, loop: asyncio.AbstractEventLoop) -> None:
+        returncode = self._reap()
+        try:
+            loop.call_soon_threadsafe(self._set_returncode, returncode)
+        except RuntimeError:  # 事件循环已关闭
+            pass
+
+
+async def _connect_pipe(fd: int) -> asyncio.StreamReader:
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    protocol = asyncio.StreamReaderProtocol(reader)
+    await loop.connect_read_pipe(lambda: protocol, os.fdopen(fd, "rb", 0))
+    return reader
+
+
+async def posix_spawn_exec(
+    filename: str,
+    *argv: str,
+    env: Dict[str, str],
+    stdout: Union[int, None] = PIPE,
+    stderr: Union[int, None] = PIPE,
+) -> SpawnedProcess:
+    """
+    与 asyncio.create_subprocess_exec 相同的用法 不支持cwd
+    stdout/stderr 为 PIPE 时创建管道 为文件描述符时交给子进程
+    """
+    file_actions: List[tuple] = []
+    read_fds: List[Optional[int]] = []
+    write_fds: List[int] = []
+    for target_fd, source in ((1, stdout), (2, stderr)):
+        if source == PIPE:
+            read_fd, write_fd = os.pipe()
+            read_fds.append(read_fd)
+            write_fds.append(write_fd)
+            source = write_fd
+        else:
+            read_fds.append(None)
+        if source is not None:
+            file_actions.append((os.POSIX_SPAWN_DUP2, source, target_fd))
+    try:
+        pid = os.posix_spawn(
+            filename, [filename, *argv], env, file_actions=file_actions
+        )
+    except BaseException:
+        for fd in read_fds:
+            if fd is not None:
+                os.close(fd)
+        raise
+    finally:
+        for fd in write_fds:  # 子进程已持有写端
+            os.close(fd)
+
+    process = SpawnedProcess(pid)
+    process._watch(asyncio.get_running_loop())
+    if read_fds[0] is not None:
+        process.stdout = await _connect_pipe(read_fds[0])
+    if read_fds[1] is not None:
+        process.stderr = await _connect_pipe(read_fds[1])
+    logger.debug(f"posix_spawn {filename} pid {pid}")
+    return process
@@ -4,14 +4,20 @@
 # Copyright 2021 LinkSense Technology CO,. Ltd
 import asyncio
 import datetime
+import json
 import logging
 import os
+import shlex
+import shutil
+import time
 from enum import Enum
-from typing import Dict, List, Optional, Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 from lk_flow.config import conf
 from lk_flow.env import logger
-from lk_flow.errors import DictionaryNotExist, RunError
+from lk_flow.errors import DictionaryNotExist, LogTypeError, RunError
+from lk_flow.models import spawn
+from lk_flow.models.log_writer import LogFileBuffer, LogTail
 from lk_flow.models.tasks import Task
 
 # For ensures that the python output is sent straight to get
@@ -26,8 +32,56 @@ class ProcessStatus(str, Enum):
     running = "running"
 
 
+class LogMode(str, Enum):
+    pipe = "pipe"  # 经管道读取 由daemon写入日志文件
+    direct = "direct"  # 子进程直接写入日志文件 不经过daemon
+
+
+class SpawnBackend(str, Enum):
+    asyncio = "asyncio"  # asyncio.create_subprocess_exec
+    posix_spawn = "posix_spawn"  # os.posix_spawn 不复制daemon页表 不支持directory
+
+
+class LogFormat(str, Enum):
+    raw = "raw"  # 原样写入子进程输出
+    json = "json"  # 每行一条json记录 {time, task, stream, pid, line}
+
+
+def _file_mtime(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _split_lines(
+    remain: bytes, data: bytes, read_size: int
+) -> Tuple[Optional[bytes], bytes]:
+    """
+    拼接上次剩余的不完整行 返回(完整的行, 新的剩余) 没有完整的行时为None
+    没有换行的超长输出也作为一行
+
+    >>> _split_lines(b"a", b"b\\nc", 16)
+    (b'ab', b'c')
+    >>> _split_lines(b"a", b"b", 16)
+    (None, b'ab')
+    >>> _split_lines(b"a", b"b", 2)
+    (b'ab', b'')
+    """
+    end = data.rfind(b"\n")
+    if end < 0 and len(remain) + len(data) < read_size:
+        return None, remain + data
+    if end < 0:
+        return remain + data, b""
+    return remain + data[:end], data[end + 1 :]
+
+
 class SubProcess:
-    def __init__(self, config: Task):
+    def __init__(
+        self,
+        config: Task,
+        exit_callback: Optional[Callable[["SubProcess"], None]] = None,
+    ):
         self.config: Task = config
         self.pid: Optional[int] = None  # Subprocess pid; None when not running
         self.state: Optional[str] = ProcessStatus.sleeping  # process state
@@ -38,6 +92,18 @@ class SubProcess:
         self.last_start_datetime: Optional[datetime.datetime] = None
         self.last_stop_datetime: Optional[datetime.datetime] = None
         self._watcher_task: Optional[asyncio.Task] = None
+        # 运行统计
+        self.start_count: int = 0
+        self.start_latency: Optional[float] = None  # 最近一次启动耗时 秒
+        self.revision: int = 0  # 状态变化时递增 供指标等缓存判断是否失效
+        # 启动参数缓存 (配置, 可执行文件, argv, env快照, 可执行文件mtime)
+        self._start_cache: Optional[
+            Tuple[tuple, str, List[str], Dict[str, str], Optional[int]]
+        ] = None
+        # 任务扩展配置缓存 (extra_json, 解析结果)
+        self._extra_cache: Optional[Tuple[Optional[str], Dict[str, Any]]] = None
+        # 进程自然退出时的回调 由Context注入 用于即时切换进程状态
+        self._exit_callback: Optional[Callable[[SubProcess], None]] = exit_callback
 
         self.stdout_logfile = self._format_log_file(
             self.config.stdout_logfile, "out.log"
@@ -45,6 +111,31 @@ class SubProcess:
         self.stderr_logfile = self._format_log_file(
             self.config.stderr_logfile, "err.log"
         )
+        # 添加任务时解析命令 命令错误在此抛出RunError 未设置命令的任务在启动时报错
+        if self.config.command is not None:
+            self._prepare_command()
+        self._spawn_backend()
+        # 最近输出的内存缓冲 跨重启保留
+        tail_size = self._get_extra().get("log_tail_size", conf.log_tail_size)
+        self.stdout_tail = LogTail(tail_size)
+        self.stderr_tail = LogTail(tail_size)
+
+    def get_log_tail(self, log_type: str = "out") -> LogTail:
+        """
+        >>> SubProcess(Task(name="t_tail", command="date")).get_log_tail("err").end
+        0
+        """
+        return self._select_log(log_type, self.stdout_tail, self.stderr_tail)
+
+    def get_log_file(self, log_type: str = "out") -> str:
+        return self._select_log(log_type, self.stdout_logfile, self.stderr_logfile)
+
+    def _select_log(self, log_type: str, out: Any, err: Any) -> Any:
+        if log_type == "out":
+            return out
+        if log_type == "err":
+            return err
+        raise LogTypeError(f"log_type必须为out或err: {log_type}")
 
     def _format_log_file(self, source_path: str, suffix: str) -> str:
         """
@@ -67,28 +158,65 @@ class SubProcess:
         return source_path
 
     def _prepare_start(self) -> Tuple[str, List[str], Dict[str, str]]:
-        # directory
-        if self.config.directory is not None:
-            cwd = self.config.directory
-            try:
-                if cwd is not None:
-                    os.chdir(cwd)
-            except OSError as why:
-                raise RunError(f"couldn't chdir to {cwd}: {why}")
-        # env
+        # directory 子进程通过cwd参数切换 daemon自身的工作目录不变
+        cwd = self.config.directory
+        if cwd is not None and not os.path.isdir(cwd):
+            raise RunError(f"couldn't chdir to {cwd}: not a directory")
+        self._prepare_command()
+        # exit_code
+        self.exit_code = None
+        return self._start_cache[1], self._start_cache[2], self._start_cache[3]
+
+    def _prepare_command(self) -> None:
+        """
+        解析命令与环境变量 结果按配置缓存
+        配置或可执行文件的mtime变化时重新解析
+        env 是解析时 daemon 环境变量(os.environ)的快照
+        之后 daemon 自身环境变量的变化 在任务配置变化或重新添加任务前不会传给子进程
+        """
+        key = (self.config.command, self.config.environment, self.config.directory)
+        cache = self._start_cache
+        if cache is not None and cache[0] == key and _file_mtime(cache[1]) == cache[4]:
+            return
         env = self._make_env()
-        # command
+        filename, argv = self._parse_command(env)
+        self._start_cache = (key, filename, argv, env, _file_mtime(filename))
+
+    def _get_extra(self) -> Dict[str, Any]:
+        """
+        解析extra_json 结果按配置缓存 extra_json变化时重新解析
+
+        >>> process = SubProcess(Task(name="t_extra", command="date"))
+        >>> process._get_extra() is process._get_extra()
+        True
+        >>> process.config.extra_json = '{"log_mode": "direct"}'
+        >>> process._get_extra()
+        {'log_mode': 'direct'}
+        """
+        extra_json = self.config.extra_json
+        cache = self._extra_cache
+        if cache is None or cache[0] != extra_json:
+            cache = self._extra_cache = (extra_json, self.config.get_extra())
+        return cache[1]
+
+    def _parse_command(self, env: Dict[str, str]) -> Tuple[str, List[str]]:
+        """
+        按shell规则拆分命令 支持引号内的空格
+
+        >>> process = SubProcess(Task(name="t_parse", command="date"))
+        >>> process._parse_command({"PATH": "/usr/bin"})[0]
+        '/usr/bin/date'
+        >>> process.config.command = 'echo "a b" c'
+        >>> process._parse_command({"PATH": "/usr/bin:/bin"})
+        ('/usr/bin/echo', ['a b', 'c'])
+        """
         if self.config.command is None:
             raise RunError("No command for {}".format(self.config))
-        if " " in self.config.command:
-            filename, *argv = self.config.command.split()
-        else:
-            filename = self.config.command
-            argv = []
-        filename = self._check_filename_exist(filename)
-        # exit_code
-        self.exit_code = None
-        return filename, argv, env
+        try:
+            filename, *argv = shlex.split(self.config.command)
+        except ValueError as why:  # 引号不匹配或命令为空
+            raise RunError(f"couldn't parse command {self.config.command}: {why}")
+        return self._check_filename_exist(filename, env), argv
 
     def _make_env(self) -> dict:
         env = os.environ.copy()
@@ -104,32 +232,87 @@ class SubProcess:
         env.update(environment)
         return env
 
-    def _check_filename_exist(self, filename: str) -> str:
+    def _check_filename_exist(self, filename: str, env: Dict[str, str]) -> str:
+        """含'/'时为相对工作目录的路径 否则在任务环境变量的PATH中查找"""
         if "/" in filename:
-            try:
-                os.stat(filename)
-                return filename
-            except FileNotFoundError:
+            path = os.path.join(self.config.directory or "", filename)
+            if not os.path.isfile(path):
                 raise RunError(f"未找到命令{self.config.command}")
-        else:
-            for _dir in ["/bin", "/usr/bin", "/usr/local/bin"]:
-                _path = os.path.join(_dir, filename)
-                try:
-                    os.stat(_path)
-                    return _path
-                except FileNotFoundError:
-                    pass
-            raise RunError("命令必须包含路径符'/'")
+            return os.path.abspath(path)
+        path = shutil.which(filename, path=env.get("PATH", os.defpath))
+        if path is None:
+            raise RunError(f"未在PATH中找到命令{filename}")
+        return path
+
+    def get_log_format(self) -> LogFormat:
+        log_format = self._get_extra().get("log_format", conf.log_format)
+        try:
+            return LogFormat(log_format)
+        except ValueError:
+            raise RunError(f"未知的日志格式{log_format}")
+
+    def _spawn_backend(self) -> SpawnBackend:
+        """
+        posix_spawn 不支持切换工作目录 不能与directory同时使用
+        当前平台没有 os.posix_spawn 时使用asyncio
+        """
+        backend = self._get_extra().get("spawn_backend", conf.spawn_backend)
+        try:
+            backend = SpawnBackend(backend)
+        except ValueError:
+            raise RunError(f"未知的启动方式{backend}")
+        if backend is not SpawnBackend.posix_spawn:
+            return backend
+        if self.config.directory is not None:
+            raise RunError(
+                f"{self.name}: spawn_backend posix_spawn 不支持设置directory"
+            )
+        if not spawn.available:
+            logger.warning(f"[{self.name}] os.posix_spawn 不可用 使用asyncio启动")
+            return SpawnBackend.asyncio
+        return backend
+
+    def _log_mode(self) -> LogMode:
+        log_mode = self._get_extra().get("log_mode", conf.log_mode)
+        try:
+            return LogMode(log_mode)
+        except ValueError:
+            raise RunError(f"未知的日志模式{log_mode}")
+
+    def _open_log_files(self) -> Tuple[int, int]:
+        """
+        direct模式下交给子进程的日志文件描述符
+        输出不经过daemon 因此不转发到系统日志 也不轮转
+        """
+        flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC
+        try:
+            stdout = os.open(self.stdout_logfile, flags, 0o644)
+        except OSError as why:
+            raise RunError(f"couldn't open {self.stdout_logfile}: {why}")
+        try:
+            stderr = os.open(self.stderr_logfile, flags, 0o644)
+        except OSError as why:
+            os.close(stdout)
+            raise RunError(f"couldn't open {self.stderr_logfile}: {why}")
+        return stdout, stderr
 
     async def _set_logger(
         self, process: asyncio.subprocess
     ) -> Tuple[asyncio.Task, asyncio.Task]:
         task_out = asyncio.create_task(
-            self._handle_log_stream(logging.INFO, process.stdout, self.stdout_logfile)
+            self._handle_log_stream(
+                logging.INFO, process.stdout, self.stdout_logfile, self.stdout_tail
+            )
         )
         asyncio.ensure_future(task_out, loop=asyncio.get_running_loop())
         task_err = asyncio.create_task(
-            self._handle_log_stream(logging.ERROR, process.stderr, self.stderr_logfile)
+            self._handle_log_stream(
+                logging.ERROR,
+                process.stderr,
+                self.stderr_logfile,
+                self.stderr_tail,
+                stream_name="err",
+            )
         )
         asyncio.ensure_future(task_err, loop=asyncio.get_running_loop())
         return task_out, task_err
@@ -139,17 +322,101 @@ class SubProcess:
         level: int,
         stream: asyncio.streams.StreamReader,
         log_file_path: str,
+        log_tail: Optional[LogTail] = None,
+        stream_name: str = "out",
+    ) -> None:
+        """
+        按块读取子进程输出 合并后交给后台写线程写入日志文件
+        log_mirror 为真时 按完整行转发到系统日志 每块一条记录
+        log_format 为json时 每行写为一条带时间戳的记录 并维护时间索引
+        log_tail 保留最近的原始输出
+        """
+        extra = self._get_extra()
+        mirror = extra.get("log_mirror", conf.log_mirror)
+        structured = self.get_log_format() is LogFormat.json
+        log_file = self._open_log_buffer(log_file_path, structured)
+        read_size = extra.get("log_read_size", conf.log_read_size)
+        remain = b""
+        try:
+            while True:
+                data = await stream.read(read_size)
+                if not data:
+                    break
+                if log_tail is not None:
+                    log_tail.append(data)
+                if not structured:
+                    await log_file.write(data)
+                    if not mirror:
+                        continue
+                lines, remain = _split_lines(remain, data, read_size)
+                if lines is not None:
+                    await self._write_lines(
+                        log_file, lines, stream_name, structured, mirror
+                    )
+            if remain:
+                await self._write_lines(
+                    log_file, remain, stream_name, structured, mirror
+                )
+        finally:
+            log_file.close()
+        await log_file.wait_closed()
+
+    def _open_log_buffer(self, log_file_path: str, structured: bool) -> LogFileBuffer:
+        extra = self._get_extra()
+        index_interval = extra.get("log_index_interval", conf.log_index_interval)
+        return LogFileBuffer(
+            log_file_path,
+            buffer_size=extra.get("log_buffer_size", conf.log_buffer_size),
+            flush_interval=extra.get("log_flush_interval", conf.log_flush_interval),
+            max_queue_size=extra.get("log_queue_size", conf.log_queue_size),
+            overflow=extra.get("log_overflow", conf.log_overflow),
+            max_bytes=extra.get("log_max_bytes", conf.log_max_bytes),
+            max_age=extra.get("log_max_age", conf.log_max_age),
+            backup_count=extra.get("log_backup_count", conf.log_backup_count),
+            compress=extra.get("log_compress", conf.log_compress),
+            index_interval=index_interval if structured else 0,
+        )
+
+    async def _write_lines(
+        self,
+        log_file: LogFileBuffer,
+        lines: bytes,
+        stream_name: str,
+        structured: bool,
+        mirror: bool,
     ) -> None:
-        f = open(log_file_path, 'ab')
-        prefix = f"\n[{self.name}] ".encode()
-        while not stream.at_eof():
-            data = await stream.readline()
-            f.write(data)
-            f.flush()
-            logger.info(prefix + data)
-        f.close()
+        """完整的行 json格式时写为记录 log_mirror为真时作为一条记录转发到系统日志"""
+        text = lines.decode(errors="replace")
+        if structured:
+            await log_file.write(self._format_records(text, stream_name))
+        if mirror:
+            logger.info(f"[{self.name}] {text}")
+
+    def _format_records(self, text: str, stream_name: str) -> bytes:
+        """
+        json格式的日志记录 同一块内的行使用相同的时间戳
+
+        >>> process = SubProcess(Task(name="t_records", command="date"))
+        >>> records = process._format_records("a\\nb", "out").decode().splitlines()
+        >>> [json.loads(record)["line"] for record in records]
+        ['a', 'b']
+        >>> json.loads(records[0])["stream"]
+        'out'
+        """
+        head = json.dumps(
+            {
+                "time": time.time(),
+                "task": self.name,
+                "stream": stream_name,
+                "pid": self.pid,
+            }
+        )
+        head = head[:-1] + ', "line": '
+        records = [head + json.dumps(line) + "}\n" for line in text.split("\n")]
+        return "".join(records).encode()
 
     async def start(self) -> None:
+        start_time = time.perf_counter()
         filename, argv, env = self._prepare_start()
 
         if self.process is not None:
@@ -157,18 +424,40 @@ class SubProcess:
             self.process = None
 
         # run
-        process = await asyncio.create_subprocess_exec(
-            filename,
-            *argv,
-            cwd=self.config.directory,
-            env=env,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
+        log_mode = self._log_mode()
+        self.get_log_format()  # 启动前检查
+        if log_mode is LogMode.direct:
+            stdout, stderr = self._open_log_files()
+        else:
+            stdout = stderr = asyncio.subprocess.PIPE
+        try:
+            if self._spawn_backend() is SpawnBackend.posix_spawn:
+                process = await spawn.posix_spawn_exec(
+                    filename, *argv, env=env, stdout=stdout, stderr=stderr
+                )
+            else:
+                process = await asyncio.create_subprocess_exec(
+                    filename,
+                    *argv,
+                    cwd=self.config.directory,
+                    env=env,
+                    stdout=stdout,
+                    stderr=stderr,
+                )
+        finally:
+            if log_mode is LogMode.direct:  # 子进程已继承文件描述符
+                os.close(stdout)
+                os.close(stderr)
         self.process = process
         self.pid = self.process.pid
+        self.start_latency = time.perf_counter() - start_time
+        self.start_count += 1
+        self.revision += 1
 
-        task_out, task_err = await self._set_logger(self.process)
+        if log_mode is LogMode.direct:
+            task_out = task_err = None
+        else:
+            task_out, task_err = await self._set_logger(self.process)
         asyncio_task = asyncio.create_task(
             self._process_watcher(process, task_out, task_err)
         )
@@ -180,33 +469,30 @@ class SubProcess:
     async def _process_watcher(
         self,
         process: asyncio.subprocess,
-        task_out: asyncio.Task,
-        task_err: asyncio.Task,
+        task_out: Optional[asyncio.Task],
+        task_err: Optional[asyncio.Task],
     ) -> int:
         """
         watcher current process, return the process exit code.
 
         if current process not manager process, will not replace pid.
+        the exit_callback is called once the managed process exits by itself.
         """
         self.state = ProcessStatus.running
         self.last_start_datetime = datetime.datetime.now()
+        self.revision += 1
         self.exit_code = await process.wait()
         self.last_stop_datetime = datetime.datetime.now()
         if self.process == process:
             self.pid = None
             # log task will stop by stream.at_eof
-            from lk_flow.core import EVENT, Context, Event
-
-            event_bus = Context.get_instance().event_bus
-            if self.exit_code == 0:
-                # normal exit
+            if self.exit_code == 0:  # normal exit
                 self.state = ProcessStatus.exit_normal
-                event_bus.publish_event(Event(EVENT.TASK_FINISH, task_name=self.name))
             else:  # raise error
                 self.state = ProcessStatus.exit_error
-                event_bus.publish_event(
-                    Event(EVENT.TASK_RUNNING_ERROR, task_name=self.name)
-                )
+            self.revision += 1
+            if self._exit_callback is not None:
+                self._exit_callback(self)
         return self.exit_code
 
     async def stop(self) -> None:
@@ -214,12 +500,16 @@ class SubProcess:
             self.process.terminate()
             self.last_stop_datetime = datetime.datetime.now()
             self._watcher_task.cancel()
-            if os.getpgid(self.pid) == self.pid:
-                os.killpg(self.pid, 9)  # kill as group
-            else:
-                os.kill(self.pid, 9)  # kill self
+            try:
+                if os.getpgid(self.pid) == self.pid:
+                    os.killpg(self.pid, 9)  # kill as group
+                else:
+                    os.kill(self.pid, 9)  # kill self
+            except ProcessLookupError:  # already exited and reaped after terminate
+                pass
             self.pid = None
             self.state = ProcessStatus.stopped
+            self.revision += 1
 
     async def restart(self) -> None:
         await self.stop()
@@ -2,7 +2,8 @@
 # encoding: utf-8
 # Created by zza on 2021/6/16 17:02
 # Copyright 2021 LinkSense Technology CO,. Ltd
-from typing import Any
+import json
+from typing import Any, Dict
 
 from pydantic import BaseModel, PydanticValueError, validator
 
@@ -11,6 +12,10 @@ class InvalidTriggerEvents(PydanticValueError):
     msg_template = "must use '__' separate event and task_name"
 
 
+class InvalidExtraJson(PydanticValueError):
+    msg_template = "extra_json must be a json object"
+
+
 class Task(BaseModel):
     name: str
     command: str = None
@@ -41,3 +46,24 @@ class Task(BaseModel):
             if "__" not in item:
                 raise InvalidTriggerEvents()
         return value
+
+    @validator("extra_json")
+    def extra_json_validator(cls, value: str) -> str:
+        if not value:
+            return "{}"
+        try:
+            extra = json.loads(value)
+        except ValueError:
+            raise InvalidExtraJson()
+        if not isinstance(extra, dict):
+            raise InvalidExtraJson()
+        return value
+
+    def get_extra(self) -> Dict[str, Any]:
+        """
+        解析extra_json 供mod读取任务级扩展配置
+
+        >>> Task(name="t", extra_json='{"misfire_policy": "skip"}').get_extra()
+        {'misfire_policy': 'skip'}
+        """
+        return json.loads(self.extra_json or "{}")
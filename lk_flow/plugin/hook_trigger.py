@@ -85,6 +85,8 @@ class HookTrigger(ModAbstraction):
     @classmethod
     def task_hook_trigger(cls, event: Event) -> None:
         """事件来后触发对应的监听任务"""
+        trigger_task_names = cls.hook_listeners[event.event_type][event.task_name]
+        if not trigger_task_names:
+            return
         context = Context.get_instance()
-        for trigger_task_name in cls.hook_listeners[event.event_type][event.task_name]:
-            context.start_task(trigger_task_name)
+        context.run_coroutine(context.start_tasks_async(list(trigger_task_names)))
@@ -2,18 +2,30 @@
 # encoding: utf-8
 # Created by zza on 2021/7/1 14:27
 # Copyright 2021 LinkSense Technology CO,. Ltd
+import asyncio
+import datetime
 import traceback
+from typing import Dict, Optional
 
 import uvicorn
-from fastapi import APIRouter, FastAPI, Request
-from starlette.responses import JSONResponse
+from fastapi import APIRouter, FastAPI, Query, Request
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
 
 from lk_flow import conf, logger
 from lk_flow.core import EVENT, Context, Event
-from lk_flow.errors import LkFlowBaseError, TaskNotFoundError
-from lk_flow.models import Task
+from lk_flow.errors import LkFlowBaseError, LogTypeError, TaskNotFoundError
+from lk_flow.models import SubProcess, Task
+from lk_flow.models.log_writer import read_records
+from lk_flow.models.subprocess import LogFormat
 from lk_flow.plugin.http_stuff.models import (
+    BatchRequest,
+    BatchResponse,
     CommonResponse,
+    EventMetricsResponse,
+    JitterResponse,
+    LogTailModel,
+    LogTailResponse,
+    LoopMonitorResponse,
     ProcessMapResponse,
     ProcessResponse,
     SaveToSqlRequest,
@@ -23,6 +35,7 @@ from lk_flow.plugin.http_stuff.models import (
     SystemInfoResponse,
     TaskResponse,
 )
+from lk_flow.utils import prometheus_summary
 
 api_router = APIRouter()
 
@@ -74,6 +87,68 @@ async def get_task(task_name: str) -> ProcessResponse:
     return ProcessResponse(data=subprocess)
 
 
+@api_router.get("/processes/{task_name}/log", response_model=LogTailResponse)
+async def task_log(
+    task_name: str,
+    n: int = 20,
+    log_type: str = "out",
+    offset: Optional[int] = None,
+    follow: bool = False,
+    since: Optional[datetime.datetime] = None,
+    until: Optional[datetime.datetime] = None,
+    limit: int = 1000,
+) -> LogTailResponse:
+    """
+    从内存缓冲查看task最近的输出 或按时间范围查询json格式的日志文件
+
+    Args:
+        task_name: 任务名
+        n: 最后n行
+        log_type: out | err
+        offset: 返回该偏移量之后的输出 用于增量查询 忽略n
+        follow: 以流的方式持续返回新输出 类似 tail -f
+        since: 起始时间 与until任一给出时按时间索引查询日志文件 需要log_format为json
+        until: 结束时间
+        limit: 按时间查询时最多返回的记录数
+
+    Returns:
+        '{"message": "ok", "code": 0, "data": {"text": "...", "offset": 1024}}'
+    """
+    context = Context.get_instance()
+    process = context.get_process(task_name)
+    if since is not None or until is not None:
+        return await _query_log_file(process, log_type, since, until, limit)
+    log_tail = process.get_log_tail(log_type)
+    if follow:
+        return StreamingResponse(log_tail.follow(n), media_type="text/plain")
+    data = log_tail.tail(n) if offset is None else log_tail.since(offset)
+    text = data.decode(errors="replace")
+    return LogTailResponse(data=LogTailModel(text=text, offset=log_tail.end))
+
+
+async def _query_log_file(
+    process: SubProcess,
+    log_type: str,
+    since: Optional[datetime.datetime],
+    until: Optional[datetime.datetime],
+    limit: int,
+) -> LogTailResponse:
+    """在线程池中读取 offset为查询结束时的文件偏移量"""
+    path = process.get_log_file(log_type)
+    if process.get_log_format() is not LogFormat.json:
+        raise LogTypeError(f"按时间查询需要json格式的日志: {process.name}")
+    records, offset = await asyncio.get_running_loop().run_in_executor(
+        None,
+        read_records,
+        path,
+        since.timestamp() if since is not None else None,
+        until.timestamp() if until is not None else None,
+        limit,
+    )
+    text = b"".join(records).decode(errors="replace")
+    return LogTailResponse(data=LogTailModel(text=text, offset=offset))
+
+
 @api_router.post("/processes/{task_name}/start", response_model=ProcessResponse)
 async def task_start(task_name: str, task: Task = None) -> ProcessResponse:
     """启动task
@@ -92,7 +167,7 @@ async def task_start(task_name: str, task: Task = None) -> ProcessResponse:
             context.get_process(task_name=task.name)
         except TaskNotFoundError:
             context.add_task(task)
-    context.start_task(task_name)
+    await context.start_task_async(task_name)
     subprocess = SubProcessModel.from_orm(context.get_process(task_name))
     return ProcessResponse(data=subprocess)
 
@@ -101,11 +176,45 @@ async def task_start(task_name: str, task: Task = None) -> ProcessResponse:
 async def task_stop(task_name: str) -> ProcessResponse:
     """手动关闭task"""
     context = Context.get_instance()
-    context.stop_task(task_name=task_name)
+    await context.stop_task_async(task_name=task_name)
     subprocess = SubProcessModel.from_orm(context.get_process(task_name))
     return ProcessResponse(data=subprocess)
 
 
+@api_router.post("/processes:batch_start", response_model=BatchResponse)
+async def task_batch_start(batch_request: BatchRequest) -> BatchResponse:
+    """并发启动多个task"""
+    context = Context.get_instance()
+    results = await context.start_tasks_async(
+        batch_request.task_names, batch_request.max_concurrency
+    )
+    return _make_batch_response(context, results)
+
+
+@api_router.post("/processes:batch_stop", response_model=BatchResponse)
+async def task_batch_stop(batch_request: BatchRequest) -> BatchResponse:
+    """并发停止多个task"""
+    context = Context.get_instance()
+    results = await context.stop_tasks_async(
+        batch_request.task_names, batch_request.max_concurrency
+    )
+    return _make_batch_response(context, results)
+
+
+def _make_batch_response(
+    context: Context, results: Dict[str, Optional[BaseException]]
+) -> BatchResponse:
+    data, errors = dict(), dict()
+    for task_name, err in results.items():
+        if err is not None:
+            errors[task_name] = getattr(err, "message", repr(err))
+            continue
+        data[task_name] = SubProcessModel.from_orm(context.get_process(task_name))
+    if errors:
+        return BatchResponse(message="failed", code=-1, data=data, errors=errors)
+    return BatchResponse(data=data)
+
+
 @api_router.post("/tasks", response_model=ProcessResponse)
 async def task_create(task: Task) -> ProcessResponse:
     context = Context.get_instance()
@@ -123,8 +232,8 @@ async def task_get(task_name: str) -> TaskResponse:
 @api_router.delete("/tasks/{task_name}", response_model=CommonResponse)
 async def task_delete(task_name: str) -> CommonResponse:
     context = Context.get_instance()
-    context.stop_task(task_name)
-    context.delete_task(task_name)
+    await context.stop_task_async(task_name)
+    await context.delete_task_async(task_name)
     return CommonResponse()
 
 
@@ -159,6 +268,75 @@ async def time_trigger_get() -> ScheduleResponse:
     return resp
 
 
+@api_router.get("/time_trigger/jitter", response_model=JitterResponse)
+async def time_trigger_jitter() -> JitterResponse:
+    """
+    获取定时任务触发抖动统计 (实际触发时间 - 计划时间)
+
+    Returns:
+        '{"message": "ok", "code": 0, "data": {"task_name": {"count": 3, "last": 0.001, "max": 0.002, "mean": 0.001}}}'
+    """
+    from lk_flow.plugin.time_trigger import TimeTrigger
+
+    context = Context.get_instance()
+    mod: TimeTrigger = context.get_mod("TimeTrigger")
+    data = {name: jitter.dict() for name, jitter in mod.FIRE_JITTER.items()}
+    return JitterResponse(data=data)
+
+
+@api_router.get("/loop_monitor", response_model=LoopMonitorResponse)
+async def loop_monitor(n: int = 60) -> LoopMonitorResponse:
+    """
+    事件循环延迟 最近n次采样与慢回调
+
+    Returns:
+        '{"message": "ok", "code": 0, "data": {"last_lag": 0.001, "samples": [[1626245940.1, 0.001]], ...}}'
+    """
+    context = Context.get_instance()
+    return LoopMonitorResponse(data=context.loop_monitor.get_stats(n))
+
+
+@api_router.get("/metrics", response_class=PlainTextResponse)
+async def metrics() -> PlainTextResponse:
+    """Prometheus 文本格式的任务与守护进程指标"""
+    from lk_flow.plugin.http_stuff.metrics import renderer
+
+    text = renderer.render(Context.get_instance())
+    return PlainTextResponse(text, media_type="text/plain; version=0.0.4")
+
+
+@api_router.get("/metrics/events", response_model=EventMetricsResponse)
+async def event_metrics(
+    fmt: str = Query("json", alias="format")
+) -> EventMetricsResponse:
+    """
+    事件总线耗时统计 按(事件类型, 监听器)记录 单位纳秒
+
+    Args:
+        fmt: 查询参数format json | prometheus
+    """
+    event_bus = Context.get_instance().event_bus
+    if fmt != "prometheus":
+        return EventMetricsResponse(data=event_bus.get_stats())
+    lines = prometheus_summary(
+        "lk_flow_event_publish_seconds",
+        "EventBus publish latency per event type",
+        (
+            ({"event": event_type.value}, histogram)
+            for event_type, histogram in event_bus.publish_histograms.items()
+        ),
+    )
+    lines += prometheus_summary(
+        "lk_flow_event_listener_seconds",
+        "EventBus listener latency per event type and listener",
+        (
+            ({"event": event_type.value, "listener": name}, histogram)
+            for event_type, name, histogram in event_bus.iter_listener_histograms()
+        ),
+    )
+    return PlainTextResponse("\n".join(lines) + "\n")
+
+
 async def start_server(
     host: str = "0.0.0.0",
     port: int = 9002,
@@ -4,6 +4,7 @@
 # Copyright 2021 LinkSense Technology CO,. Ltd
 import asyncio
 import functools
+import time
 from typing import Callable, Dict, List, Optional
 
 import pandas
@@ -35,6 +36,7 @@ def _async_request(method: str, url: str, **kwargs) -> requests_async.models.Res
 class ControlCommands:
     _not_commands: List[str] = ["get_all_commands"]
     _server_no_run_message: str = "lk_flow 服务未启动"
+    _log_poll_interval: float = 0.5  # log命令跟踪task输出的轮询间隔 秒
 
     def __init__(
         self, host: str = "0.0.0.0", port: int = 9002, api_path: str = "/lk_flow/api/v1"
@@ -240,6 +242,24 @@ class ControlCommands:
         result: dict = requests.get(url).json()["data"]
         return result
 
+    def jitter(self) -> dict:
+        """查看定时任务触发抖动(秒)"""
+        url = f"{self._base_path}/time_trigger/jitter"
+        result: dict = requests.get(url).json()["data"]
+        return result
+
+    def event_metrics(self) -> dict:
+        """查看事件总线各监听器耗时统计(纳秒)"""
+        url = f"{self._base_path}/metrics/events"
+        result: dict = requests.get(url).json()["data"]
+        return result
+
+    def loop_monitor(self, n: int = 10) -> dict:
+        """查看事件循环延迟(秒)与慢回调"""
+        url = f"{self._base_path}/loop_monitor"
+        result: dict = requests.get(url, params={"n": n}).json()["data"]
+        return result
+
     def log(
         self,
         task_name: str = None,
@@ -249,9 +269,10 @@ class ControlCommands:
     ) -> Optional[str]:  # noqa: VNE001
         """
         use like "tail -f task.log -n 20"
+        task的输出从服务的内存缓冲读取 可查看远程主机上的task
 
         Args:
-            task_name: task_name in system
+            task_name: task_name in system, 为空时查看系统日志
             n: last log lang
             log_type: out or err | stdout_logfile stderr_logfile
         Returns:
@@ -259,18 +280,13 @@ class ControlCommands:
             use ctrl+C to break
         """
         if task_name:
-            url = f"{self._base_path}/processes/{task_name}"
-            res = requests.get(url).json()
-            if log_type == "out":
-                file_path = res["data"]["stdout_logfile"]
-            elif log_type == "err":
-                file_path = res["data"]["stderr_logfile"]
-            else:
-                raise KeyError("choose file_path in (out, err)")
-        else:
-            url = f"{self._base_path}/system"
-            res = requests.get(url).json()
-            file_path = res["data"]["system_log_file"]
+            if log_type not in ("out", "err"):
+                raise KeyError("choose log_type in (out, err)")
+            self._follow_task_log(task_name, n, log_type)
+            return
+        url = f"{self._base_path}/system"
+        res = requests.get(url).json()
+        file_path = res["data"]["system_log_file"]
 
         import subprocess  # noqa: S404
 
@@ -287,3 +303,22 @@ class ControlCommands:
         except KeyboardInterrupt:  # pragma: no cover
             pass
         return
+
+    def _follow_task_log(self, task_name: str, n: int, log_type: str) -> None:
+        """按offset轮询增量输出"""
+        url = f"{self._base_path}/processes/{task_name}/log"
+        res = requests.get(url, params={"n": n, "log_type": log_type}).json()
+        if res["code"] != 0:
+            print(res["message"])
+            return
+        print(res["data"]["text"], end="")
+        offset = res["data"]["offset"]
+        try:
+            while true_func():
+                time.sleep(self._log_poll_interval)
+                params = {"log_type": log_type, "offset": offset}
+                data = requests.get(url, params=params).json()["data"]
+                print(data["text"], end="")
+                offset = data["offset"]
+        except KeyboardInterrupt:  # pragma: no cover
+            pass
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# encoding: utf-8
+# Created by agent on 2026/10/18 16:21
+# Copyright 2021 LinkSense Technology CO,. Ltd
+"""
+Prometheus 文本格式的进程监控指标
+每个任务的样本行按 SubProcess.revision 缓存 状态未变化时不重新格式化
+"""
+import time
+from typing import Dict, List, Tuple
+
+from lk_flow.core import Context
+from lk_flow.models import SubProcess
+from lk_flow.models.subprocess import ProcessStatus
+from lk_flow.utils import prometheus_labels
+
+# (指标名, 类型, 说明) 与 _task_lines 的返回值一一对应
+TASK_METRICS: Tuple[Tuple[str, str, str], ...] = (
+    ("lk_flow_task_running", "gauge", "1 if the task process is running"),
+    ("lk_flow_task_pid", "gauge", "pid of the task process, 0 if not running"),
+    (
+        "lk_flow_task_starts_total",
+        "counter",
+        "times the task process was started, including cron fires",
+    ),
+    (
+        "lk_flow_task_last_exit_code",
+        "gauge",
+        "exit code of the last finished run, -1 if none",
+    ),
+    (
+        "lk_flow_task_last_start_latency_seconds",
+        "gauge",
+        "time spent spawning the task process on its last start",
+    ),
+)
+
+
+class MetricsRenderer(object):
+    """按指标分组输出 任务行缓存于 {task_name: (process, revision, 样本行, 标签)}"""
+
+    def __init__(self):
+        self._cache: Dict[str, Tuple[SubProcess, int, Tuple[str, ...], str]] = {}
+
+    def render(self, context: Context) -> str:
+        rows = []
+        for name, process in context.get_all_processes():
+            cached = self._cache.get(name)
+            if (
+                cached is None
+                or cached[0] is not process
+                or cached[1] != process.revision
+            ):
+                label = "{" + prometheus_labels({"task": name}) + "}"
+                cached = (process, process.revision, _task_lines(process, label), label)
+                self._cache[name] = cached
+            rows.append(cached)
+        if len(self._cache) > len(rows):  # 清理已删除的任务
+            self._cache = {row[0].name: row for row in rows}
+
+        lines: List[str] = []
+        for index, (metric, metric_type, help_text) in enumerate(TASK_METRICS):
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} {metric_type}")
+            lines.extend(row[2][index] for row in rows)
+        # 运行时长随时间变化 每次实时计算
+        now = time.time()
+        lines.append(
+            "# HELP lk_flow_task_uptime_seconds seconds since the task started"
+        )
+        lines.append("# TYPE lk_flow_task_uptime_seconds gauge")
+        for process, _, _, label in rows:
+            if process.state is ProcessStatus.running and process.last_start_datetime:
+                uptime = now - process.last_start_datetime.timestamp()
+                lines.append(f"lk_flow_task_uptime_seconds{label} {uptime:.3f}")
+        lines.extend(_daemon_lines(context))
+        return "\n".join(lines) + "\n"
+
+
+def _task_lines(process: SubProcess, label: str) -> Tuple[str, ...]:
+    running = 1 if process.state is ProcessStatus.running else 0
+    exit_code = -1 if process.exit_code is None else process.exit_code
+    latency = process.start_latency or 0.0
+    return (
+        f"lk_flow_task_running{label} {running}",
+        f"lk_flow_task_pid{label} {process.pid or 0}",
+        f"lk_flow_task_starts_total{label} {process.start_count}",
+        f"lk_flow_task_last_exit_code{label} {exit_code}",
+        f"lk_flow_task_last_start_latency_seconds{label} {latency:.6f}",
+    )
+
+
+def _daemon_lines(context: Context) -> List[str]:
+    return [
+        "# HELP lk_flow_tasks number of tasks loaded",
+        "# TYPE lk_flow_tasks gauge",
+        f"lk_flow_tasks {len(context.get_all_processes())}",
+        "# HELP lk_flow_tasks_running number of running tasks",
+        "# TYPE lk_flow_tasks_running gauge",
+        f"lk_flow_tasks_running {len(context.get_running_processes())}",
+        "# HELP lk_flow_heartbeat_lag_seconds delay of the last heartbeat",
+        "# TYPE lk_flow_heartbeat_lag_seconds gauge",
+        f"lk_flow_heartbeat_lag_seconds {context.heartbeat_lag:.6f}",
+        "# HELP lk_flow_event_queue_depth events waiting in listener queues",
+        "# TYPE lk_flow_event_queue_depth gauge",
+        f"lk_flow_event_queue_depth {context.event_bus.queue_depth()}",
+        "# HELP lk_flow_loop_lag_seconds event loop lag of the last sample",
+        "# TYPE lk_flow_loop_lag_seconds gauge",
+        f"lk_flow_loop_lag_seconds {context.loop_monitor.last_lag:.6f}",
+        "# HELP lk_flow_slow_callbacks_total asyncio callbacks slower than "
+        "slow_callback_duration",
+        "# TYPE lk_flow_slow_callbacks_total counter",
+        f"lk_flow_slow_callbacks_total {context.loop_monitor.slow_callback_count}",
+    ]
+
+
+renderer = MetricsRenderer()
@@ -3,9 +3,9 @@
 # Created by zza on 2021/7/1 14:26
 # Copyright 2021 LinkSense Technology CO,. Ltd
 import datetime
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, conint
 
 from lk_flow.models import Task
 
@@ -44,6 +44,15 @@ class ProcessMapResponse(CommonResponse):
     data: Optional[Dict[str, SubProcessModel]] = None
 
 
+class BatchRequest(BaseModel):
+    task_names: List[str]
+    max_concurrency: Optional[conint(gt=0)] = None  # 默认使用系统配置 max_concurrency
+
+
+class BatchResponse(ProcessMapResponse):
+    errors: Dict[str, str] = {}  # 启停失败的task及错误信息
+
+
 class SaveToSqlRequest(BaseModel):
     force: bool = True
 
@@ -57,6 +66,20 @@ class ScheduleResponse(CommonResponse):
     data: Dict[str, datetime.datetime] = {}  # 进程时间表
 
 
+class JitterResponse(CommonResponse):
+    data: Dict[str, Dict[str, float]] = {}  # 定时任务触发抖动 单位秒
+
+
+class EventMetricsResponse(CommonResponse):
+    # {event_type: {"publish": {...}, "listeners": {listener_name: {...}}}} 耗时单位纳秒
+    data: Dict[str, Dict[str, Any]] = {}
+
+
+class LoopMonitorResponse(CommonResponse):
+    # last_lag lag samples slow_callbacks 单位秒
+    data: Dict[str, Any] = {}
+
+
 class SystemInfo(BaseModel):
     system_start_time: datetime.datetime
     mod_config: Dict[str, Dict[str, Any]]
@@ -69,3 +92,13 @@ class SystemInfo(BaseModel):
 
 class SystemInfoResponse(CommonResponse):
     data: SystemInfo
+
+
+class LogTailModel(BaseModel):
+    text: str = ""
+    # 已输出的总字节数 作为下次增量查询的offset 按时间查询时为日志文件中的结束位置
+    offset: int = 0
+
+
+class LogTailResponse(CommonResponse):
+    data: Optional[LogTailModel] = None
@@ -73,7 +73,10 @@ class SQLOrmMod(ModAbstraction):
         task_orm = session.query(TaskOrm).all()
         tasks = [Task.from_orm(_task) for _task in task_orm]
         for task in tasks:
-            cls.context.add_task(task)
+            try:
+                cls.context.add_task(task)
+            except RunError as why:  # 命令错误的任务不影响其他任务加载
+                logger.error(f"load task {task.name} failed: {why.message}")
         session.close()
 
     @classmethod
@@ -2,31 +2,242 @@
 # encoding: utf-8
 # Created by zza on 2021/6/16 11:05
 # Copyright 2021 LinkSense Technology CO,. Ltd
+import asyncio
+import copy
 import datetime
-from typing import Any, Dict
+import heapq
+import zlib
+from collections import OrderedDict
+from enum import Enum
+from typing import Any, Dict, List, Optional, Tuple
 
 from croniter import croniter
+from pydantic import BaseModel, ValidationError
 
 from lk_flow.core import EVENT, Context, Event, ModAbstraction
+from lk_flow.env import logger
 from lk_flow.models.tasks import Task
 
 
+class FireJitter(BaseModel):
+    """定时任务实际触发时间与计划时间之差 单位秒"""
+
+    count: int = 0
+    last: float = 0.0
+    max: float = 0.0
+    mean: float = 0.0
+
+    def add(self, jitter: float) -> None:
+        self.count += 1
+        self.last = jitter
+        self.max = max(self.max, jitter)
+        self.mean += (jitter - self.mean) / self.count
+
+
+class MisfirePolicy(str, Enum):
+    """错过触发(实际触发晚于计划时间超过misfire_grace_time)时的处理策略"""
+
+    fire_once = "fire_once"  # 合并错过的多次触发 只补发一次
+    fire_all = "fire_all"  # 逐次补发错过的触发 最多保留misfire_max_backlog次
+    skip = "skip"  # 跳过错过的触发 等待下一次计划时间
+
+
+class MisfireSetting(BaseModel):
+    """任务级错过触发配置 读取自 Task.extra_json"""
+
+    policy: MisfirePolicy = MisfirePolicy.fire_once
+    grace_time: float = 5.0  # 秒
+
+
+def jitter_offset(task_name: str, window: float) -> datetime.timedelta:
+    """
+    按任务名哈希得到[0, window)秒内的固定触发偏移 重启后保持不变
+
+    >>> jitter_offset("t_task", 0)
+    datetime.timedelta(0)
+    >>> jitter_offset("t_task", 30) == jitter_offset("t_task", 30) < datetime.timedelta(seconds=30)
+    True
+    """
+    if window <= 0:
+        return datetime.timedelta(0)
+    millis = zlib.crc32(task_name.encode()) % max(int(window * 1000), 1)
+    return datetime.timedelta(milliseconds=millis)
+
+
+class SpawnRateLimiter:
+    """
+    令牌桶 限制每秒启动的任务数 rate<=0时不限制
+
+    >>> limiter = SpawnRateLimiter(rate=1)
+    >>> now = datetime.datetime(2021, 7, 1)
+    >>> limiter.acquire(now), limiter.acquire(now)
+    (True, False)
+    >>> limiter.next_available(now)
+    datetime.datetime(2021, 7, 1, 0, 0, 1)
+    """
+
+    def __init__(self, rate: float = 0):
+        self.rate = rate
+        self._tokens = max(rate, 1.0)
+        self._updated: Optional[datetime.datetime] = None
+
+    def acquire(self, now: datetime.datetime) -> bool:
+        """取一个令牌 令牌不足时返回False"""
+        if self.rate <= 0:
+            return True
+        self._refill(now)
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def next_available(self, now: datetime.datetime) -> datetime.datetime:
+        """下一个令牌可用的时间"""
+        if self.rate <= 0:
+            return now
+        self._refill(now)
+        wait = max(1 - self._tokens, 0) / self.rate
+        return now + datetime.timedelta(seconds=wait)
+
+    def _refill(self, now: datetime.datetime) -> None:
+        if self._updated is not None and now > self._updated:
+            elapsed = (now - self._updated).total_seconds()
+            self._tokens = min(self._tokens + elapsed * self.rate, max(self.rate, 1.0))
+        if self._updated is None or now > self._updated:
+            self._updated = now
+
+
+class CronCache:
+    """
+    按表达式缓存已解析的croniter
+    有任务引用的表达式常驻 无引用的按LRU保留至多maxsize个
+
+    >>> cache = CronCache(maxsize=0)
+    >>> cache.acquire("*/5 * * * *", datetime.datetime(2021, 7, 1)).get_next(datetime.datetime)
+    datetime.datetime(2021, 7, 1, 0, 5)
+    >>> len(cache)
+    1
+    >>> cache.release("*/5 * * * *")
+    >>> len(cache)
+    0
+    """
+
+    def __init__(self, maxsize: int = 128):
+        self.maxsize = maxsize
+        self._templates: "OrderedDict[str, croniter]" = OrderedDict()
+        self._refs: Dict[str, int] = {}
+
+    def acquire(self, expression: str, start_time: datetime.datetime) -> croniter:
+        """返回从start_time开始迭代的croniter 表达式只在首次使用时解析"""
+        template = self._templates.get(expression)
+        if template is None:
+            template = croniter(expression)
+            self._templates[expression] = template
+        self._templates.move_to_end(expression)
+        self._refs[expression] = self._refs.get(expression, 0) + 1
+        self._evict()
+        iterator = copy.copy(template)  # 共享解析结果 只复制迭代状态
+        iterator.set_current(start_time, force=True)
+        return iterator
+
+    def release(self, expression: str) -> None:
+        """任务删除时释放引用"""
+        count = self._refs.get(expression, 0) - 1
+        if count > 0:
+            self._refs[expression] = count
+            return
+        self._refs.pop(expression, None)
+        self._evict()
+
+    def clear(self) -> None:
+        self._templates.clear()
+        self._refs.clear()
+
+    def __len__(self) -> int:
+        return len(self._templates)
+
+    def _evict(self) -> None:
+        if len(self._templates) <= self.maxsize:
+            return
+        unused = [_expr for _expr in self._templates if _expr not in self._refs]
+        for expression in unused[: max(len(self._templates) - self.maxsize, 0)]:
+            del self._templates[expression]
+
+
 class TimeTrigger(ModAbstraction):
     PROCESS_SCHEDULE: Dict[str, datetime.datetime] = {}  # 进程时间表
+    FIRE_JITTER: Dict[str, FireJitter] = {}  # 触发抖动统计
+    # (next_datetime, task_name) 最小堆 与PROCESS_SCHEDULE不一致的条目视为已失效
+    _schedule_heap: List[Tuple[datetime.datetime, str]] = []
+    # 到期时仍在运行的任务 {task_name: 计划时间} 进程结束后立即补发一次
+    _pending: Dict[str, datetime.datetime] = {}
+    # 解析过的cron表达式 与每个任务的croniter迭代器
+    _cron_cache: CronCache = CronCache()
+    _iterators: Dict[str, croniter] = {}
+    # 错过触发处理
+    _misfire_settings: Dict[str, MisfireSetting] = {}
+    # 因补发或启动限流而推迟的任务 {task_name: 原计划时间}
+    _deferred_from: Dict[str, datetime.datetime] = {}
+    misfire_max_burst: int = 32  # 每轮最多补发的错过触发数 其余推迟到下一轮
+    misfire_burst_interval: float = 1.0  # 补发轮次间隔 秒
+    misfire_max_backlog: int = 10  # fire_all策略下每个任务最多保留的待补发次数
+    _default_misfire: MisfireSetting = MisfireSetting()
+    # 分散触发 每个任务在计划时间后固定偏移[0, jitter_window)秒 任务可在extra_json中覆盖
+    jitter_window: float = 0.0
+    _jitter_offsets: Dict[str, datetime.timedelta] = {}
+    # 全局启动限流 超出的任务推迟到有令牌时
+    _spawn_limiter: SpawnRateLimiter = SpawnRateLimiter()
+    # precise模式 使用loop.call_at在堆顶计划时间精确触发 不依赖心跳间隔
+    _precise: bool = False
+    _timer: Optional[asyncio.TimerHandle] = None
+    _timer_datetime: Optional[datetime.datetime] = None
     context: Context
 
     @classmethod
     def setup_mod(cls, mod_config: Dict[str, Any]) -> None:
         # register event listener
         cls.context = Context.get_instance()
+        cls._precise = mod_config.get("precise", False)
+        cls._cron_cache.maxsize = mod_config.get("cron_cache_size", 128)
+        cls._default_misfire = MisfireSetting(
+            policy=mod_config.get("misfire_policy", MisfirePolicy.fire_once),
+            grace_time=mod_config.get("misfire_grace_time", cls.context.sleep_time),
+        )
+        cls.misfire_max_burst = mod_config.get("misfire_max_burst", 32)
+        cls.misfire_burst_interval = mod_config.get("misfire_burst_interval", 1.0)
+        cls.misfire_max_backlog = mod_config.get("misfire_max_backlog", 10)
+        cls.jitter_window = mod_config.get("jitter_window", 0.0)
+        cls._spawn_limiter = SpawnRateLimiter(
+            rate=mod_config.get("max_spawns_per_second", 0)
+        )
         # add event listener
         cls.context.event_bus.add_listener(EVENT.HEARTBEAT, cls._work)
 
+        cls.PROCESS_SCHEDULE.clear()
+        cls.FIRE_JITTER.clear()
+        cls._schedule_heap.clear()
+        cls._pending.clear()
+        cls._cron_cache.clear()
+        cls._iterators.clear()
+        cls._misfire_settings.clear()
+        cls._deferred_from.clear()
+        cls._jitter_offsets.clear()
+        cls._cancel_timer()
         cls._init_time_trigger()
         cls.context.event_bus.add_listener(EVENT.TASK_ADD, cls._add_task_event_listener)
         cls.context.event_bus.add_listener(
             EVENT.TASK_DELETE, cls._delete_task_event_listener
         )
+        for event_type in (
+            EVENT.TASK_FINISH,
+            EVENT.TASK_RUNNING_ERROR,
+            EVENT.TASK_STOP,
+        ):
+            cls.context.event_bus.add_listener(event_type, cls._task_exit_listener)
+
+    @classmethod
+    def teardown_mod(cls) -> None:
+        cls._cancel_timer()
 
     @classmethod
     def _work(cls, event: Event) -> None:
@@ -39,24 +250,208 @@ class TimeTrigger(ModAbstraction):
         Returns:
             None
         """
-        for task_name, next_datetime in cls.PROCESS_SCHEDULE.items():
-            # 在运行的跳过
-            if cls.context.is_running(task_name):
+        cls._fire_due(event.now)
+
+    @classmethod
+    def _fire_due(cls, now: datetime.datetime) -> None:
+        """
+        启动所有到期任务 只弹出已到期的堆条目 O(k log n)
+        错过触发的任务按策略处理 每轮补发数不超过misfire_max_burst
+        超出启动限流的任务推迟到下一个令牌可用时
+        """
+        heap = cls._schedule_heap
+        due_task_names, deferred = {}, []
+        burst = limited = 0
+        while heap and heap[0][0] <= now:
+            next_datetime, task_name = heapq.heappop(heap)
+            if cls.PROCESS_SCHEDULE.get(task_name) != next_datetime:
+                continue  # 已删除或已重新计划
+            scheduled = cls._deferred_from.pop(task_name, next_datetime)
+            # 在运行的(含本轮刚触发的) 等进程结束后再触发
+            if task_name in due_task_names or cls.context.is_running(task_name):
+                cls._pending[task_name] = scheduled
+                continue
+            misfire = cls._check_misfire(task_name, scheduled, now, burst, deferred)
+            if misfire is None:
+                continue
+            if not cls._spawn_limiter.acquire(now):
+                limited += 1
+                retry = cls._spawn_limiter.next_available(now)
+                deferred.append((task_name, scheduled, retry))
                 continue
-            process_manager = cls.context.get_process(task_name)
-            # 未运行的判断是否运行
-            if cls._should_start(event.now, task_name):
-                cls.context.start_task(task_name)
-                # croniter 精度为分钟当前分钟会重复触发
-                next_datetime = croniter(
-                    process_manager.config.cron_expression,
-                    datetime.datetime.now() + datetime.timedelta(minutes=1),
-                ).next(datetime.datetime)
-                cls.PROCESS_SCHEDULE[task_name] = next_datetime
+            burst += misfire
+            due_task_names[task_name] = None  # 有序集合
+            cls._fired(task_name, scheduled, now)
+        if deferred:
+            logger.warning(
+                f"[TimeTrigger] {len(deferred)} tasks deferred, "
+                f"{limited} by max_spawns_per_second"
+            )
+            for task_name, scheduled, retry in deferred:
+                cls._deferred_from[task_name] = scheduled
+                cls._set_schedule(task_name, retry)
+        if due_task_names:
+            cls.context.run_coroutine(
+                cls.context.start_tasks_async(list(due_task_names))
+            )
+        cls._arm()
+
+    @classmethod
+    def _check_misfire(
+        cls,
+        task_name: str,
+        scheduled: datetime.datetime,
+        now: datetime.datetime,
+        burst: int,
+        deferred: List[Tuple[str, datetime.datetime, datetime.datetime]],
+    ) -> Optional[bool]:
+        """
+        返回本次触发是否为补发
+        skip策略已跳过 或本轮补发数已满推迟到下一轮时返回None
+        """
+        if not cls._is_misfire(task_name, scheduled, now):
+            return False
+        if cls._misfire_settings[task_name].policy is MisfirePolicy.skip:
+            cls._skip(task_name, scheduled, now)
+            return None
+        if burst >= cls.misfire_max_burst:
+            retry = now + datetime.timedelta(seconds=cls.misfire_burst_interval)
+            deferred.append((task_name, scheduled, retry))
+            return None
+        return True
+
+    @classmethod
+    def _is_misfire(
+        cls, task_name: str, scheduled: datetime.datetime, now: datetime.datetime
+    ) -> bool:
+        """实际触发晚于计划时间超过宽限时间"""
+        grace_time = cls._misfire_settings[task_name].grace_time
+        return (now - scheduled).total_seconds() > grace_time
+
+    @classmethod
+    def _fired(
+        cls, task_name: str, scheduled: datetime.datetime, now: datetime.datetime
+    ) -> None:
+        """记录触发抖动 并计算下一次触发时间"""
+        cls.FIRE_JITTER.setdefault(task_name, FireJitter()).add(
+            (now - scheduled).total_seconds()
+        )
+        # 迭代器停在scheduled对应的cron时间 准时触发时增量计算下一次
+        offset = cls._jitter_offsets.get(task_name, datetime.timedelta(0))
+        iterator = cls._iterators[task_name]
+        next_datetime = iterator.get_next(datetime.datetime) + offset
+        if next_datetime > now:
+            cls._set_schedule(task_name, next_datetime)
+            return
+        # scheduled 与 now 之间还有错过的触发
+        policy = cls._misfire_settings[task_name].policy
+        if policy is MisfirePolicy.fire_all and cls.misfire_max_backlog > 0:
+            # 逐次补发 只保留最近的misfire_max_backlog次
+            iterator.set_current(now - offset, force=True)
+            earliest = now - offset
+            for _ in range(cls.misfire_max_backlog):
+                earliest = iterator.get_prev(datetime.datetime)
+            next_datetime = max(next_datetime - offset, earliest)
+            iterator.set_current(next_datetime, force=True)
+            next_datetime += offset
+        else:  # 合并为一次 从当前时间继续
+            iterator.set_current(now - offset, force=True)
+            next_datetime = iterator.get_next(datetime.datetime) + offset
+        cls._set_schedule(task_name, next_datetime)
+
+    @classmethod
+    def _skip(
+        cls, task_name: str, scheduled: datetime.datetime, now: datetime.datetime
+    ) -> None:
+        """跳过错过的触发 计划到当前时间之后的下一次"""
+        logger.info(f"[TimeTrigger] skip misfired {task_name} at {scheduled}")
+        offset = cls._jitter_offsets.get(task_name, datetime.timedelta(0))
+        iterator = cls._iterators[task_name]
+        iterator.set_current(now - offset, force=True)
+        cls._set_schedule(task_name, iterator.get_next(datetime.datetime) + offset)
+
+    @classmethod
+    def _task_exit_listener(cls, event: Event) -> None:
+        """到期时仍在运行的任务 在进程结束后立即补发"""
+        task_name = event.task_name
+        scheduled = cls._pending.pop(task_name, None)
+        if scheduled is None:
+            return
+        now = datetime.datetime.now()
+        if (
+            cls._is_misfire(task_name, scheduled, now)
+            and cls._misfire_settings[task_name].policy is MisfirePolicy.skip
+        ):
+            cls._skip(task_name, scheduled, now)
+        elif not cls._spawn_limiter.acquire(now):
+            cls._deferred_from[task_name] = scheduled
+            cls._set_schedule(task_name, cls._spawn_limiter.next_available(now))
+        else:
+            cls._fired(task_name, scheduled, now)
+            cls.context.run_coroutine(cls.context.start_task_async(task_name))
+        cls._arm()
+
+    @classmethod
+    def _set_schedule(cls, task_name: str, next_datetime: datetime.datetime) -> None:
+        cls.PROCESS_SCHEDULE[task_name] = next_datetime
+        heapq.heappush(cls._schedule_heap, (next_datetime, task_name))
+        # 失效条目过多时重建堆
+        if len(cls._schedule_heap) > 2 * len(cls.PROCESS_SCHEDULE) + 64:
+            cls._schedule_heap[:] = [
+                (_datetime, _name) for _name, _datetime in cls.PROCESS_SCHEDULE.items()
+            ]
+            heapq.heapify(cls._schedule_heap)
+
+    @classmethod
+    def _arm(cls) -> None:
+        """
+        在最近的计划时间再次检查
+        precise模式使用loop.call_at定时器 否则请求 Context.entry_loop 提前发送HEARTBEAT
+        """
+        heap = cls._schedule_heap
+        while heap and cls.PROCESS_SCHEDULE.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+        if not heap:
+            return
+        next_datetime = heap[0][0]
+        if not cls._precise:
+            cls.context.wakeup_at(next_datetime)
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:  # 无运行中的事件循环 退回心跳触发
+            cls.context.wakeup_at(next_datetime)
+            return
+        if cls._timer is not None and cls._timer_datetime <= next_datetime:
+            return
+        cls._cancel_timer()
+        delay = (next_datetime - datetime.datetime.now()).total_seconds()
+        cls._timer = loop.call_at(loop.time() + max(delay, 0), cls._on_timer)
+        cls._timer_datetime = next_datetime
+
+    @classmethod
+    def _on_timer(cls) -> None:
+        cls._timer = None
+        cls._timer_datetime = None
+        cls._fire_due(datetime.datetime.now())
+
+    @classmethod
+    def _cancel_timer(cls) -> None:
+        if cls._timer is not None:
+            cls._timer.cancel()
+        cls._timer = None
+        cls._timer_datetime = None
 
     @classmethod
     def _delete_task_event_listener(cls, event: Event) -> None:
         cls.PROCESS_SCHEDULE.pop(event.task_name, None)
+        cls.FIRE_JITTER.pop(event.task_name, None)
+        cls._pending.pop(event.task_name, None)
+        cls._misfire_settings.pop(event.task_name, None)
+        cls._deferred_from.pop(event.task_name, None)
+        cls._jitter_offsets.pop(event.task_name, None)
+        if cls._iterators.pop(event.task_name, None) is not None:
+            cls._cron_cache.release(event.task.cron_expression)
 
     @classmethod
     def _add_task_event_listener(cls, event: Event) -> None:
@@ -88,10 +483,40 @@ class TimeTrigger(ModAbstraction):
         使用TASK_ADD事件触发
         """
         if task.cron_expression:  # 定时启动
-            next_datetime = croniter(
-                task.cron_expression, datetime.datetime.now()
-            ).next(datetime.datetime)
-            cls.PROCESS_SCHEDULE[task.name] = next_datetime
+            extra = task.get_extra()
+            cls._misfire_settings[task.name] = cls._misfire_setting(task.name, extra)
+            offset = jitter_offset(
+                task.name, extra.get("jitter_window", cls.jitter_window)
+            )
+            cls._jitter_offsets[task.name] = offset
+            # 从 now - offset 开始迭代 使偏移后的首次触发不早于当前时间
+            iterator = cls._cron_cache.acquire(
+                task.cron_expression, datetime.datetime.now() - offset
+            )
+            cls._iterators[task.name] = iterator
+            next_datetime = iterator.get_next(datetime.datetime) + offset
+            cls._set_schedule(task.name, next_datetime)
+            cls._arm()
+
+    @classmethod
+    def _misfire_setting(cls, task_name: str, extra: Dict[str, Any]) -> MisfireSetting:
+        """
+        读取任务的错过触发配置
+        此时任务已注册到Context 配置错误时记录日志并使用默认配置 不中断添加
+        """
+        try:
+            return MisfireSetting(
+                policy=extra.get("misfire_policy", cls._default_misfire.policy),
+                grace_time=extra.get(
+                    "misfire_grace_time", cls._default_misfire.grace_time
+                ),
+            )
+        except ValidationError as err:
+            logger.error(
+                f"[TimeTrigger] invalid misfire setting of {task_name}, "
+                f"use default: {err}"
+            )
+            return cls._default_misfire
 
     @classmethod
     def _init_time_trigger(cls) -> None:
@@ -102,10 +527,3 @@ class TimeTrigger(ModAbstraction):
         tasks = [i.config for _, i in cls.context.get_all_processes()]
         for task in tasks:
             cls._add_task(task)
-
-    @classmethod
-    def _should_start(cls, now: datetime.datetime, task_name: str) -> bool:
-        """判断任务是否需要开始"""
-        if now >= cls.PROCESS_SCHEDULE[task_name]:
-            return True
-        return False
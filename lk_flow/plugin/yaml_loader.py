@@ -8,7 +8,7 @@ from typing import Any, Callable, Dict, List
 import yaml
 from lk_flow.core import Context, ModAbstraction
 from lk_flow.env import logger
-from lk_flow.errors import DirNotFoundError, YamlFileExistsError
+from lk_flow.errors import DirNotFoundError, RunError, YamlFileExistsError
 from lk_flow.models import Task
 
 
@@ -46,7 +46,10 @@ class YamlLoader(ModAbstraction):
         cls.context = Context.get_instance()
         for file_name in os.listdir(yaml_path):
             yaml_file_path = os.path.join(yaml_path, file_name)
-            cls.read_yaml_file(yaml_file_path)
+            try:
+                cls.read_yaml_file(yaml_file_path)
+            except RunError as why:  # 命令错误的任务不影响其他任务加载
+                logger.error(f"load {yaml_file_path} failed: {why.message}")
 
     @classmethod
     def read_yaml_file(cls, yaml_file_path: str) -> None:
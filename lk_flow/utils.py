@@ -12,34 +12,197 @@ import inspect
 import logging
 import os
 import time
-from typing import Any, Callable
+from enum import Enum
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 
 from lk_flow.env import logger
 
 
+class OverflowPolicy(str, Enum):
+    """有界队列(事件监听器队列 日志写入队列)已满时的处理策略"""
+
+    drop_newest = "drop_newest"  # 丢弃新数据
+    drop_oldest = "drop_oldest"  # 丢弃队列中最早的数据
+    # 背压 等待队列空位 同步的 publish_event 无法等待 见 ListenerProxy
+    block = "block"
+
+
+class Histogram(object):
+    """
+    耗时直方图 按2的幂次分桶 单位纳秒
+
+    >>> histogram = Histogram()
+    >>> for ns in (100, 200, 300, 5000):
+    ...     histogram.observe(ns)
+    >>> histogram.count, histogram.min, histogram.max
+    (4, 100, 5000)
+    >>> histogram.quantile(0.5), histogram.quantile(1)
+    (256, 8192)
+    """
+
+    __slots__ = ("buckets", "count", "sum", "min", "max")
+
+    def __init__(self):
+        self.buckets: List[int] = [0] * 65  # 第i个桶为 [2**(i-1), 2**i)
+        self.count = 0
+        self.sum = 0
+        self.min = 0
+        self.max = 0
+
+    def observe(self, value: int) -> None:
+        self.buckets[min(value.bit_length(), 64)] += 1
+        if not self.count or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> int:
+        """分位数的估计值 返回所在桶的上界"""
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if bucket_count and seen >= rank:
+                return 1 << index
+        return 0
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.mean,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+        }
+
+
+def prometheus_labels(labels: Dict[str, Any]) -> str:
+    """
+    Prometheus 标签 转义反斜杠 双引号与换行
+
+    >>> prometheus_labels({"task": 'a"b'})
+    'task="a\\\\"b"'
+    """
+    return ",".join(
+        '{}="{}"'.format(
+            k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        )
+        for k, v in labels.items()
+    )
+
+
+def prometheus_summary(
+    name: str,
+    help_text: str,
+    samples: Iterable[Tuple[Dict[str, str], Histogram]],
+    scale: float = 1e-9,
+) -> List[str]:
+    """
+    按 Prometheus 文本格式输出summary 默认将纳秒转换为秒
+
+    >>> histogram = Histogram()
+    >>> histogram.observe(1000)
+    >>> print("\\n".join(prometheus_summary("t_seconds", "test", [({"a": "b"}, histogram)])))
+    # HELP t_seconds test
+    # TYPE t_seconds summary
+    t_seconds{a="b",quantile="0.5"} 1.024e-06
+    t_seconds{a="b",quantile="0.99"} 1.024e-06
+    t_seconds_sum{a="b"} 1e-06
+    t_seconds_count{a="b"} 1
+    # TYPE t_seconds_max gauge
+    t_seconds_max{a="b"} 1e-06
+    """
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} summary"]
+    max_lines = [f"# TYPE {name}_max gauge"]
+    for labels, histogram in samples:
+        label = prometheus_labels(labels)
+        for quantile in (0.5, 0.99):
+            value = histogram.quantile(quantile) * scale
+            lines.append(f'{name}{{{label},quantile="{quantile}"}} {value:g}')
+        lines.append(f"{name}_sum{{{label}}} {histogram.sum * scale:g}")
+        lines.append(f"{name}_count{{{label}}} {histogram.count}")
+        max_lines.append(f"{name}_max{{{label}}} {histogram.max * scale:g}")
+    return lines + max_lines
+
+
+# time_consuming_log 的耗时统计 {函数名: Histogram}
+TIME_CONSUMING: Dict[str, Histogram] = {}
+
+
+class _LazyArguments(object):
+    """日志记录实际输出时才绑定并格式化参数"""
+
+    __slots__ = ("signature", "args", "kwargs")
+
+    def __init__(
+        self, signature: Optional[inspect.Signature], args: tuple, kwargs: dict
+    ):
+        self.signature = signature
+        self.args = args
+        self.kwargs = kwargs
+
+    def __str__(self) -> str:
+        if self.signature is not None:
+            try:
+                bound = self.signature.bind(*self.args, **self.kwargs)
+                return str(dict(bound.arguments))
+            except TypeError:
+                pass
+        return f"{self.args}, {self.kwargs}"
+
+
 def time_consuming_log(log_level: logging.INFO) -> Callable:
-    """耗时日志装饰器"""
+    """
+    耗时日志装饰器
+    函数签名只解析一次 参数在日志输出时才格式化 耗时累计到 TIME_CONSUMING 直方图
+    """
 
     def middle_wrapper(func: Callable) -> Callable:
+        try:
+            signature = inspect.signature(func)
+        except (TypeError, ValueError):  # 部分内置函数没有签名
+            signature = None
+        # functools.partial 与可调用对象没有 __name__
+        qualname = getattr(func, "__qualname__", None) or repr(func)
+        name = getattr(func, "__name__", qualname)
+        histogram = TIME_CONSUMING.setdefault(qualname, Histogram())
+
         @functools.wraps(func)
         def wrapper(*args, **kwargs) -> Any:
-            bound_values = inspect.signature(func).bind(*args, **kwargs)
-
-            start_log = "[Func {}]: {}(**{})".format(
-                func.__name__, func.__name__, dict(bound_values.arguments)
-            )
-            logger.log(log_level, start_log)
-            start_time = time.time()
+            enabled = logger.isEnabledFor(log_level)
+            if enabled:
+                logger.log(
+                    log_level,
+                    "[Func %s]: %s(**%s)",
+                    name,
+                    name,
+                    _LazyArguments(signature, args, kwargs),
+                )
+            start_time = time.perf_counter_ns()
 
             ret = func(*args, **kwargs)
 
-            used_time = round(time.time() - start_time, 6)
-            end_log = "[Func {}](finish in {}s) return: {}".format(
-                func.__name__, used_time, ret
-            )
-            logger.log(log_level, end_log)
+            used_time = time.perf_counter_ns() - start_time
+            histogram.observe(used_time)
+            if enabled:
+                logger.log(
+                    log_level,
+                    "[Func %s](finish in %ss) return: %s",
+                    name,
+                    round(used_time / 1e9, 6),
+                    ret,
+                )
             return ret
 
+        wrapper.histogram = histogram
         return wrapper
 
     return middle_wrapper
@@ -209,3 +209,37 @@ class TestHttpControlServer(TestLkFlow):
         url = "http://localhost:9002/lk_flow/api/v1/processes/t_ls/start"
         res = await requests_async.post(url, json=json)
         assert res.json()["code"] == 0
+
+        url = "http://localhost:9002/lk_flow/api/v1/processes:batch_start"
+        json = {"task_names": ["t_ls", "t_not_exist"], "max_concurrency": 2}
+        res = (await requests_async.post(url, json=json)).json()
+        assert "t_ls" in res["data"]
+        assert "t_not_exist" in res["errors"]
+        url = "http://localhost:9002/lk_flow/api/v1/processes:batch_stop"
+        res = await requests_async.post(url, json={"task_names": ["t_ls"]})
+        assert res.json()["code"] == 0
+        json = {"task_names": ["t_ls"], "max_concurrency": 0}
+        res = await requests_async.post(url, json=json)
+        assert res.status_code == 422
+
+        url = "http://localhost:9002/lk_flow/api/v1/processes/t_ls/log"
+        res = (await requests_async.get(url, params={"n": 5})).json()
+        assert res["data"]["offset"] == len(res["data"]["text"].encode())
+        params = {"offset": res["data"]["offset"]}
+        res = (await requests_async.get(url, params=params)).json()
+        assert res["data"]["text"] == ""
+        res = (await requests_async.get(url, params={"log_type": "x"})).json()
+        assert res["code"] == -1
+
+        url = "http://localhost:9002/lk_flow/api/v1/metrics/events"
+        res = (await requests_async.get(url)).json()
+        assert "Context._close_loop" in res["data"]["exec_system_close"]["listeners"]
+        res = await requests_async.get(url, params={"format": "prometheus"})
+        assert "# TYPE lk_flow_event_listener_seconds summary" in res.text
+        url = "http://localhost:9002/lk_flow/api/v1/metrics"
+        res = await requests_async.get(url)
+        assert 'lk_flow_task_running{task="t_ls"}' in res.text
+        assert "lk_flow_loop_lag_seconds" in res.text
+        url = "http://localhost:9002/lk_flow/api/v1/loop_monitor"
+        res = (await requests_async.get(url, params={"n": 5})).json()
+        assert len(res["data"]["samples"]) <= 5
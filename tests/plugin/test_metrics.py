@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# encoding: utf-8
+# Created by agent on 2026/10/18 16:21
+# Copyright 2021 LinkSense Technology CO,. Ltd
+import asyncio
+
+import pytest
+
+from lk_flow.config import conf
+from lk_flow.core import Context
+from lk_flow.models import Task
+from lk_flow.plugin.http_stuff.metrics import MetricsRenderer
+from tests.test_lk_flow import TestLkFlow
+
+
+class TestMetrics(TestLkFlow):
+    @pytest.mark.asyncio
+    async def test_render(self):
+        context = Context(conf)
+        context.add_task(Task(name="t_metrics", command="sleep 5"))
+        renderer = MetricsRenderer()
+        text = renderer.render(context)
+        assert '\nlk_flow_task_running{task="t_metrics"} 0\n' in text
+        assert "lk_flow_task_uptime_seconds{" not in text
+        assert "\nlk_flow_tasks 1\n" in text
+
+        await context.start_task_async("t_metrics")
+        await asyncio.sleep(0.1)  # 等待watcher更新状态
+        text = renderer.render(context)
+        pid = context.get_process("t_metrics").pid
+        assert f'\nlk_flow_task_pid{{task="t_metrics"}} {pid}\n' in text
+        assert '\nlk_flow_task_running{task="t_metrics"} 1\n' in text
+        assert 'lk_flow_task_uptime_seconds{task="t_metrics"}' in text
+
+        await context.stop_task_async("t_metrics")
+        await context.start_task_async("t_metrics")
+        text = renderer.render(context)
+        assert '\nlk_flow_task_starts_total{task="t_metrics"} 2\n' in text
+        await context.delete_task_async("t_metrics")
+        assert "t_metrics" not in renderer.render(context)
+
+    def test_render_benchmark(self, benchmark):
+        context = Context(conf)
+        for i in range(2000):
+            context.add_task(Task(name=f"t_metrics_{i}", command="/usr/bin/true"))
+        renderer = MetricsRenderer()
+        renderer.render(context)
+        cached_lines = renderer._cache["t_metrics_0"][2]
+
+        # 状态未变化时只拼接缓存的样本行
+        text = benchmark(renderer.render, context)
+        assert text.count("\nlk_flow_task_running{") == 2000
+        assert renderer._cache["t_metrics_0"][2] is cached_lines
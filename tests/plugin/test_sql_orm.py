@@ -40,3 +40,16 @@ class TestSqlOrm(TestLkFlow):
         with pytest.raises(ValueError):
             self.mod.create_task_orm(make_echo_task)
         self.mod.delete_task_orm(make_echo_task)
+
+    def test_bad_command(self, caplog):
+        context = Context(conf)
+        self.mod.setup_mod({"SQLALCHEMY_DATABASE_URI": "sqlite:///lk_flow.db"})
+        bad_task = Task(name="t_orm_bad", command="t_missing_command")
+        self.mod.create_task_orm(bad_task, force=True)
+        try:
+            self.mod.setup_mod({"SQLALCHEMY_DATABASE_URI": "sqlite:///lk_flow.db"})
+        finally:
+            self.mod.delete_task_orm(bad_task)
+        # 命令错误的任务被跳过并记录日志
+        assert "load task t_orm_bad failed: " in caplog.text
+        assert "t_orm_bad" not in dict(context.get_all_processes())
@@ -2,12 +2,16 @@
 # encoding: utf-8
 # Created by zza on 2021/6/29 17:13
 # Copyright 2021 LinkSense Technology CO,. Ltd
+import asyncio
 import datetime
+import json
+
+import pytest
 
 from lk_flow.config import conf
 from lk_flow.core import EVENT, Context, Event
 from lk_flow.models import Task
-from lk_flow.plugin.time_trigger import TimeTrigger
+from lk_flow.plugin.time_trigger import TimeTrigger, jitter_offset
 from tests.test_lk_flow import TestLkFlow
 
 
@@ -33,6 +37,10 @@ class TestTimeTrigger(TestLkFlow):
         context.add_task(task_3)
 
         assert task.name in TimeTrigger.PROCESS_SCHEDULE
+        # 堆顶为最近的计划时间 并已请求提前唤醒
+        next_datetime = min(TimeTrigger.PROCESS_SCHEDULE.values())
+        assert TimeTrigger._schedule_heap[0][0] == next_datetime
+        assert context._next_wakeup == next_datetime
 
         event = Event(
             EVENT.HEARTBEAT, now=datetime.datetime.now() + datetime.timedelta(seconds=2)
@@ -47,3 +55,147 @@ class TestTimeTrigger(TestLkFlow):
         )
 
         context.delete_task(task_2.name)
+        assert task_2.name not in TimeTrigger.PROCESS_SCHEDULE
+        # 未到期时不弹出任何条目
+        heap_size = len(TimeTrigger._schedule_heap)
+        TimeTrigger._work(
+            Event(EVENT.HEARTBEAT, now=datetime.datetime.now() - datetime.timedelta(1))
+        )
+        assert len(TimeTrigger._schedule_heap) == heap_size
+
+    def test_cron_cache(self):
+        context = Context(conf)
+        TimeTrigger.setup_mod({})
+        for i in range(3):
+            context.add_task(
+                Task(
+                    name=f"t_cron_{i}",
+                    command="/usr/bin/date",
+                    cron_expression="0 0 * * *",
+                )
+            )
+        # 同一表达式只解析一次 每个任务独立迭代
+        assert len(TimeTrigger._cron_cache) == 1
+        assert len(TimeTrigger._iterators) == 3
+        next_datetime = TimeTrigger.PROCESS_SCHEDULE["t_cron_0"]
+        TimeTrigger._fired("t_cron_0", next_datetime, next_datetime)
+        one_day_later = next_datetime + datetime.timedelta(days=1)
+        assert TimeTrigger.PROCESS_SCHEDULE["t_cron_0"] == one_day_later
+        assert TimeTrigger.PROCESS_SCHEDULE["t_cron_1"] == next_datetime
+        for i in range(3):
+            context.delete_task(f"t_cron_{i}")
+        assert not TimeTrigger._iterators
+
+    def test_misfire(self, caplog):
+        context = Context(conf)
+        TimeTrigger.setup_mod({"misfire_max_burst": 2})
+
+        def _add(name, policy):
+            extra_json = json.dumps({"misfire_policy": policy})
+            context.add_task(
+                Task(
+                    name=name,
+                    command="/usr/bin/true",
+                    cron_expression="* * * * *",
+                    extra_json=extra_json,
+                )
+            )
+
+        _add("t_skip", "skip")
+        for i in range(4):
+            _add(f"t_fire_once_{i}", "fire_once")
+        # 模拟事件循环阻塞了10分钟
+        stall = datetime.datetime.now() + datetime.timedelta(minutes=10)
+        TimeTrigger._fire_due(stall)
+
+        assert "t_skip" not in TimeTrigger.FIRE_JITTER
+        assert TimeTrigger.PROCESS_SCHEDULE["t_skip"] > stall
+        # 补发数受 misfire_max_burst 限制 其余推迟到下一轮
+        assert len(TimeTrigger.FIRE_JITTER) == 2
+        assert len(TimeTrigger._deferred_from) == 2
+        retry = stall + datetime.timedelta(seconds=TimeTrigger.misfire_burst_interval)
+        for task_name in TimeTrigger._deferred_from:
+            assert TimeTrigger.PROCESS_SCHEDULE[task_name] == retry
+        TimeTrigger._fire_due(retry)
+        assert len(TimeTrigger.FIRE_JITTER) == 4
+        assert not TimeTrigger._deferred_from
+        # fire_once 合并为一次 fire_all 只保留最近 misfire_max_backlog 次待补发
+        assert TimeTrigger.PROCESS_SCHEDULE["t_fire_once_0"] > retry
+        _add("t_fire_all", "fire_all")
+        scheduled = TimeTrigger.PROCESS_SCHEDULE["t_fire_all"]
+        TimeTrigger._fired("t_fire_all", scheduled, stall)
+        backlog = datetime.timedelta(minutes=TimeTrigger.misfire_max_backlog)
+        assert stall - backlog <= TimeTrigger.PROCESS_SCHEDULE["t_fire_all"] <= stall
+
+        # 配置错误时使用默认策略 任务仍被计划
+        _add("t_error_policy", "error_policy")
+        assert "invalid misfire setting of t_error_policy" in caplog.text
+        assert TimeTrigger._misfire_settings["t_error_policy"] == (
+            TimeTrigger._default_misfire
+        )
+        assert "t_error_policy" in TimeTrigger.PROCESS_SCHEDULE
+
+    def test_spread(self):
+        context = Context(conf)
+        TimeTrigger.setup_mod({"jitter_window": 30, "max_spawns_per_second": 2})
+        for i in range(5):
+            context.add_task(
+                Task(
+                    name=f"t_spread_{i}",
+                    command="/usr/bin/true",
+                    cron_expression="0 0 * * *",
+                )
+            )
+        # 偏移由任务名决定 在窗口内且可复现
+        schedule = dict(TimeTrigger.PROCESS_SCHEDULE)
+        for task_name, next_datetime in schedule.items():
+            offset = jitter_offset(task_name, 30)
+            assert offset == TimeTrigger._jitter_offsets[task_name]
+            assert (next_datetime - offset).time() == datetime.time(0, 0)
+        assert len(set(schedule.values())) > 1
+        # 偏移后的计划时间推进一天
+        TimeTrigger._fired("t_spread_0", schedule["t_spread_0"], schedule["t_spread_0"])
+        one_day_later = schedule["t_spread_0"] + datetime.timedelta(days=1)
+        assert TimeTrigger.PROCESS_SCHEDULE["t_spread_0"] == one_day_later
+
+        # 同时到期 每秒最多启动2个 其余推迟
+        now = max(schedule.values())
+        TimeTrigger.setup_mod({"max_spawns_per_second": 2})
+        for task_name in schedule:
+            TimeTrigger._set_schedule(task_name, now)
+        TimeTrigger._fire_due(now)
+        assert len(TimeTrigger.FIRE_JITTER) == 2
+        assert len(TimeTrigger._deferred_from) == 3
+        retry = min(
+            TimeTrigger.PROCESS_SCHEDULE[_name] for _name in TimeTrigger._deferred_from
+        )
+        assert retry == now + datetime.timedelta(seconds=0.5)
+        TimeTrigger._fire_due(now + datetime.timedelta(seconds=1))
+        assert len(TimeTrigger.FIRE_JITTER) == 4
+        assert len(TimeTrigger._deferred_from) == 1
+        for i in range(5):
+            context.delete_task(f"t_spread_{i}")
+
+    @pytest.mark.asyncio
+    async def test_precise(self):
+        context = Context(conf)
+        TimeTrigger.setup_mod({"precise": True})
+        task = Task(
+            name="t_precise_task",
+            command="/usr/bin/date",
+            cron_expression="* * * * * *",
+        )
+        context.add_task(task)
+        assert TimeTrigger._timer is not None
+        await asyncio.sleep(2.5)
+        jitter = TimeTrigger.FIRE_JITTER[task.name]
+        # 秒级表达式每秒触发 且不依赖心跳
+        assert jitter.count >= 2
+        assert 0 <= jitter.mean <= jitter.max
+        assert 0 <= jitter.last <= jitter.max
+        # 精确定时器的延迟小于一个心跳间隔
+        assert jitter.max < context.sleep_time
+        context.delete_task(task.name)
+        assert task.name not in TimeTrigger.FIRE_JITTER
+        TimeTrigger.teardown_mod()
+        assert TimeTrigger._timer is None
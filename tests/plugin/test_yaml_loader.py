@@ -47,3 +47,18 @@ class TestYamlLoader(TestLkFlow):
         with pytest.raises(YamlFileExistsError):
             YamlLoader.dump_to_file(task, self.dir_name, force=False)
         YamlLoader.dump_to_file(task, self.dir_name, force=True)
+
+    def test_bad_command(self, tmp_path, caplog):
+        context = Context(conf)
+        YamlLoader.dump_to_file(
+            Task(name="t_yaml_bad", command="t_missing_command"), str(tmp_path)
+        )
+        YamlLoader.dump_to_file(
+            Task(name="t_yaml_good", command="/usr/bin/date"), str(tmp_path)
+        )
+        YamlLoader.setup_mod({"task_yaml_dir": str(tmp_path)})
+        # 命令错误的任务被跳过并记录日志 不影响其他任务
+        bad_path = os.path.join(tmp_path, "t_yaml_bad.yaml")
+        assert f"load {bad_path} failed: " in caplog.text
+        tasks = dict(context.get_all_processes())
+        assert "t_yaml_good" in tasks and "t_yaml_bad" not in tasks
@@ -2,6 +2,8 @@
 # encoding: utf-8
 # Created by zza on 2021/7/1 16:28
 # Copyright 2021 LinkSense Technology CO,. Ltd
+import asyncio
+import datetime
 import shutil
 from typing import Any, Dict
 
@@ -11,7 +13,13 @@ from lk_flow import Task, logger
 from lk_flow.__main__ import run
 from lk_flow.config import conf
 from lk_flow.core import EVENT, Context, Event, ModAbstraction
-from lk_flow.errors import DuplicateModError, LkFlowBaseError, ModNotFoundError
+from lk_flow.errors import (
+    DuplicateModError,
+    LkFlowBaseError,
+    ModNotFoundError,
+    RunningError,
+    TaskNotFoundError,
+)
 
 
 class TestContext:
@@ -94,6 +102,91 @@ class TestContext:
 
         gc.collect()
 
+    @pytest.mark.asyncio
+    async def test_process_exit_callback(self):
+        context = Context(config=conf)
+        finished = []
+        context.event_bus.add_listener(EVENT.TASK_FINISH, finished.append)
+        context.add_task(Task(name="t_exit_callback", command="/usr/bin/echo exit"))
+        context.start_task("t_exit_callback")
+        for _ in range(50):
+            if finished:
+                break
+            await asyncio.sleep(0.1)
+        # 无需HEARTBEAT 进程退出即切换状态
+        assert finished[0].task_name == "t_exit_callback"
+        assert context.is_running("t_exit_callback") is False
+        assert "t_exit_callback" in dict(context.get_stopped_processes())
+
+    @pytest.mark.asyncio
+    async def test_async_task_api(self):
+        context = Context(config=conf)
+        names = [f"t_async_{i}" for i in range(5)]
+        for name in names:
+            context.add_task(Task(name=name, command="/usr/bin/sleep 10"))
+        await asyncio.gather(*(context.start_task_async(name) for name in names))
+        assert all(context.is_running(name) for name in names)
+
+        await context.stop_task_async(names[0])
+        assert context.is_running(names[0]) is False
+        for name in names:
+            await context.delete_task_async(name)
+        assert not dict(context.get_all_processes())
+
+        for name in names:
+            context.add_task(Task(name=name, command="/usr/bin/sleep 10"))
+        results = await context.start_tasks_async(names + ["t_not_exist"], 2)
+        assert all(context.is_running(name) for name in names)
+        assert isinstance(results["t_not_exist"], TaskNotFoundError)
+        for max_concurrency in (0, -1):
+            with pytest.raises(RunningError):
+                await context.stop_tasks_async(names, max_concurrency)
+        results = await context.stop_tasks_async(names)
+        assert not any(results.values())
+        assert not dict(context.get_running_processes())
+        for name in names:
+            await context.delete_task_async(name)
+
+        context.add_task(Task(name="t_background", command="/usr/bin/sleep 10"))
+        task = context.run_coroutine(context.start_task_async("t_background"))
+        await task
+        assert context.is_running("t_background")
+        await context.delete_task_async("t_background")
+
+    @pytest.mark.asyncio
+    async def test_wakeup_at(self):
+        context = Context(config=conf)
+        context.sleep_time = 60
+        heartbeats = []
+        context.event_bus.add_listener(EVENT.HEARTBEAT, heartbeats.append)
+        loop_task = asyncio.ensure_future(context.entry_loop())
+        await asyncio.sleep(0.1)
+        context.wakeup_at(datetime.datetime.now() + datetime.timedelta(seconds=0.2))
+        await asyncio.sleep(0.5)
+        assert len(heartbeats) == 2
+        # 提前唤醒的心跳延迟
+        assert context.heartbeat_lag >= 0
+        context.event_bus.publish_event(Event(EVENT.EXEC_SYSTEM_CLOSE))
+        await asyncio.wait_for(loop_task, 1)
+
+    @pytest.mark.asyncio
+    async def test_wakeup_at_past(self):
+        context = Context(config=conf)
+        context.sleep_time = 60
+        heartbeats = []
+
+        def _past_wakeup(event: Event) -> None:
+            heartbeats.append(event)
+            context.wakeup_at(event.now - datetime.timedelta(seconds=1))
+
+        context.event_bus.add_listener(EVENT.HEARTBEAT, _past_wakeup)
+        loop_task = asyncio.ensure_future(context.entry_loop())
+        # 唤醒时间已过时 心跳循环仍让出事件循环
+        await asyncio.sleep(0.05)
+        assert len(heartbeats) > 1
+        context.event_bus.publish_event(Event(EVENT.EXEC_SYSTEM_CLOSE))
+        await asyncio.wait_for(loop_task, 1)
+
     def test_config(self):
         import os
 
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# encoding: utf-8
+# Created by agent on 2026/10/18 16:03
+# Copyright 2021 LinkSense Technology CO,. Ltd
+import asyncio
+import functools
+import logging
+
+import pytest
+
+from lk_flow.core import (
+    EVENT,
+    Event,
+    EventBus,
+    HeartbeatEvent,
+    OverflowPolicy,
+    SystemEvent,
+    TaskEvent,
+)
+from lk_flow.core.event import DictEvent
+from lk_flow.env import logger
+from lk_flow.utils import TIME_CONSUMING
+
+
+class TestEventBus:
+    def test_listener_chain(self):
+        bus = EventBus()
+        called = []
+
+        def _first(event):
+            called.append("first")
+
+        def _stop(event):
+            called.append("stop")
+            return True
+
+        def _last(event):
+            called.append("last")
+
+        for listener in (_first, _stop, _last):
+            bus.add_listener(EVENT.HEARTBEAT, listener)
+        bus.publish_event(Event(EVENT.HEARTBEAT))
+        # 返回 True 后不再传递
+        assert called == ["first", "stop"]
+
+        called.clear()
+        bus.remove_listener(EVENT.HEARTBEAT, _stop)
+        bus.remove_listener(EVENT.HEARTBEAT, _stop)
+        bus.publish_event(Event(EVENT.HEARTBEAT))
+        assert called == ["first", "last"]
+        # 无监听器的事件
+        bus.publish_event(Event(EVENT.TASK_ADD))
+        # 按(事件类型, 监听器)统计耗时
+        stats = bus.get_stats()["heartbeat"]
+        assert stats["publish"]["count"] == 2
+        listeners = stats["listeners"]
+        assert listeners[_first.__qualname__]["count"] == 2
+        assert _stop.__qualname__ not in listeners  # 已移除
+        assert listeners[_last.__qualname__]["count"] == 1
+        assert "task_add" not in bus.get_stats()
+
+        level = logger.level
+        logger.setLevel(logging.DEBUG)
+        try:
+            called.clear()
+            bus.publish_event(Event(EVENT.HEARTBEAT))
+            assert called == ["first", "last"]
+            # DEBUG下监听器耗时累计到直方图
+            histogram = TIME_CONSUMING[_first.__qualname__]
+            assert histogram.count >= 1
+            assert histogram.quantile(1) >= histogram.max
+        finally:
+            logger.setLevel(level)
+
+        # 同名的监听器分别统计 移除后不再保留
+        for _ in range(2):
+            bus.add_listener(EVENT.TASK_ADD, lambda event: None)
+        bus.publish_event(Event(EVENT.TASK_ADD))
+        listeners = bus.get_stats()["task_add"]["listeners"]
+        assert len(listeners) == 2
+        assert all(_stats["count"] == 1 for _stats in listeners.values())
+        bus.remove_listener(EVENT.HEARTBEAT, _last)
+        assert list(bus.get_stats()["heartbeat"]["listeners"]) == [_first.__qualname__]
+
+    def test_partial_listener(self, capsys):
+        bus = EventBus()
+        called = []
+
+        class _Callable:
+            def __call__(self, event):
+                called.append("instance")
+
+        def _listener(tag, event):
+            called.append(tag)
+
+        # 没有 __name__ 或签名的监听器
+        bus.add_listener(EVENT.HEARTBEAT, functools.partial(_listener, "partial"))
+        bus.add_listener(EVENT.HEARTBEAT, _Callable())
+        bus.add_listener(EVENT.HEARTBEAT, print)
+        bus.add_listener(EVENT.HEARTBEAT, functools.partial(_listener, "last"))
+        bus.publish_event(Event(EVENT.HEARTBEAT))
+        assert called == ["partial", "instance", "last"]
+
+        level = logger.level
+        logger.setLevel(logging.DEBUG)
+        try:
+            called.clear()
+            bus.publish_event(Event(EVENT.HEARTBEAT))
+            assert called == ["partial", "instance", "last"]
+        finally:
+            logger.setLevel(level)
+        assert capsys.readouterr().out.count("EVENT.HEARTBEAT") == 2
+
+    def test_typed_event(self):
+        event = Event(EVENT.TASK_ADD, task_name="t_event")
+        assert type(event) is TaskEvent
+        assert event.task_name == "t_event" and event.task is None
+        # 紧凑存储 无 __dict__
+        assert not hasattr(event, "__dict__")
+        assert type(Event(EVENT.HEARTBEAT, now=None)) is HeartbeatEvent
+        assert type(Event(EVENT.SYSTEM_CLOSE)) is SystemEvent
+        # 未定义的参数 兼容旧用法
+        event = Event(EVENT.TASK_ADD, task_name="t_event", value=1)
+        assert type(event) is DictEvent
+        assert event.value == 1 and event.event_type is EVENT.TASK_ADD
+        assert repr(event) == (
+            "DictEvent(EVENT.TASK_ADD, task_name='t_event', value=1)"
+        )
+
+    def test_publish_event(self, benchmark):
+        bus = EventBus()
+        for _ in range(3):
+            bus.add_listener(EVENT.HEARTBEAT, lambda event: None)
+        event = Event(EVENT.HEARTBEAT, now=None)
+
+        # 单次发布开销 (INFO日志级别)
+        benchmark(bus.publish_event, event)
+
+    @pytest.mark.asyncio
+    async def test_async_listener(self):
+        bus = EventBus()
+        called = []
+
+        async def _slow(event):
+            await asyncio.sleep(0.1)
+            called.append(event.value)
+
+        async def _hang(event):
+            await asyncio.sleep(10)
+            called.append("hang")
+
+        bus.add_listener(EVENT.HEARTBEAT, _slow)
+        bus.add_listener(EVENT.HEARTBEAT, _hang, timeout=0.05)
+        # 同步发布不等待 async 监听器
+        bus.publish_event(Event(EVENT.HEARTBEAT, value=1))
+        assert called == []
+        await asyncio.sleep(0.2)
+        assert called == [1]
+        # 异步发布按序等待 超时的监听器被取消
+        await bus.publish_event_async(Event(EVENT.HEARTBEAT, value=2))
+        assert called == [1, 2]
+        bus.remove_listener(EVENT.HEARTBEAT, _hang)
+        assert len(bus._dispatch[EVENT.HEARTBEAT][1]) == 1
+
+    @pytest.mark.asyncio
+    async def test_listener_queue(self):
+        bus = EventBus()
+        called = {policy: [] for policy in OverflowPolicy}
+
+        def _make_listener(policy):
+            async def _listener(event):
+                await asyncio.sleep(0.01)
+                called[policy].append(event.value)
+
+            return _listener
+
+        listeners = {}
+        for policy in OverflowPolicy:
+            listeners[policy] = _make_listener(policy)
+            bus.add_listener(
+                EVENT.TASK_ADD, listeners[policy], queue_size=2, overflow=policy
+            )
+        for i in range(5):
+            bus.publish_event(Event(EVENT.TASK_ADD, value=i))
+        await asyncio.sleep(0.2)
+        # 队列满后按策略丢弃 block策略同步发布时另起至多queue_size个后台任务
+        assert called[OverflowPolicy.drop_newest] == [0, 1]
+        assert called[OverflowPolicy.drop_oldest] == [3, 4]
+        assert sorted(called[OverflowPolicy.block]) == [0, 1, 2, 3]
+
+        called[OverflowPolicy.block].clear()
+        for i in range(5):
+            await bus.publish_event_async(Event(EVENT.TASK_ADD, value=i))
+        await asyncio.sleep(0.2)
+        # 异步发布时 block策略等待队列空位 保持顺序
+        assert called[OverflowPolicy.block] == [0, 1, 2, 3, 4]
+        for listener in listeners.values():
+            bus.remove_listener(EVENT.TASK_ADD, listener)
+        assert not bus._dispatch[EVENT.TASK_ADD][1]
+
+    @pytest.mark.asyncio
+    async def test_listener_queue_block_bound(self):
+        bus = EventBus()
+
+        async def _slow(event):
+            await asyncio.sleep(0.05)
+
+        bus.add_listener(EVENT.TASK_ADD, _slow, queue_size=2, overflow="block")
+        proxy = bus._listeners[EVENT.TASK_ADD][0]
+        for i in range(1000):
+            bus.publish_event(Event(EVENT.TASK_ADD, value=i))
+            # 同步发布无法等待 排队与后台运行的事件都不超过queue_size
+            assert proxy.qsize() <= 2 and len(proxy._tasks) <= 2
+        assert proxy.dropped == 1000 - 4
+        bus.remove_listener(EVENT.TASK_ADD, _slow)
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# encoding: utf-8
+# Created by agent on 2026/10/18 16:24
+# Copyright 2021 LinkSense Technology CO,. Ltd
+import asyncio
+import time
+
+import pytest
+
+from lk_flow.core import EVENT, EventBus, LoopMonitor
+
+
+class TestLoopMonitor:
+    @pytest.mark.asyncio
+    async def test_loop_lag(self):
+        bus = EventBus()
+        lag_events = []
+        bus.add_listener(EVENT.LOOP_LAG, lag_events.append)
+        monitor = LoopMonitor(
+            bus, interval=0.05, lag_threshold=0.1, slow_callback_duration=0.05
+        )
+        loop = asyncio.get_running_loop()
+        handle_run = asyncio.Handle._run
+        monitor.start()
+        await asyncio.sleep(0.12)
+        assert monitor.samples
+        assert not lag_events
+
+        def _blocking_plugin():
+            time.sleep(0.2)
+
+        loop.call_soon(_blocking_plugin)
+        await asyncio.sleep(0.12)
+        # 阻塞的回调推迟了采样 并被记录为慢回调
+        assert len(lag_events) == 1
+        assert lag_events[0].lag >= 0.1
+        assert "_blocking_plugin" in lag_events[0].callback
+        stats = monitor.get_stats(n=5)
+        assert stats["slow_callback_count"] >= 1
+        assert len(stats["samples"]) <= 5
+        assert stats["lag"]["max"] >= 0.1
+
+        monitor.stop()
+        # 恢复被替换的 Handle._run
+        assert asyncio.Handle._run is handle_run
+        count = len(monitor.samples)
+        await asyncio.sleep(0.1)
+        assert len(monitor.samples) == count
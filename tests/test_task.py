@@ -3,15 +3,27 @@
 # Created by zza on 2021/6/16 18:22
 # Copyright 2021 LinkSense Technology CO,. Ltd
 import asyncio
+import contextlib
+import gzip
+import json
+import logging
+import os
+import resource
+import signal
 import sys
+import threading
+import time
 
 import pytest
 from pydantic import ValidationError
 
 from lk_flow import Context, conf
-from lk_flow.errors import DictionaryNotExist, RunError
+from lk_flow.errors import DictionaryNotExist, LogTypeError, RunError
+from lk_flow.models import spawn
+from lk_flow.models.log_writer import LogFileBuffer, LogTail, find_offset, read_records
 from lk_flow.models.subprocess import ProcessStatus, SubProcess
 from lk_flow.models.tasks import Task
+from lk_flow.utils import OverflowPolicy
 
 
 class TestTask:
@@ -115,6 +127,475 @@ class TestTask:
         with pytest.raises(RunError):
             await p_manger.start()
 
+    @pytest.mark.asyncio
+    async def test_stop_exited(self):
+        p_manger = SubProcess(Task(name="t_stop_exited", command="sleep 10"))
+        await p_manger.start()
+        pid = p_manger.pid
+        os.kill(pid, signal.SIGKILL)
+        # 进程已退出并被回收 事件循环尚未得知
+        with contextlib.suppress(ChildProcessError):
+            os.waitpid(pid, 0)
+        assert p_manger.is_running()
+        await p_manger.stop()
+        assert p_manger.state is ProcessStatus.stopped
+        assert p_manger.pid is None
+
+    @pytest.mark.asyncio
+    async def test_log_stream(self, caplog):
+        command = f"{sys.executable} -c \"print('line1');print('line2',end='')\""
+        p_manger = SubProcess(Task(name="t_log_stream", command=command))
+        if os.path.exists(p_manger.stdout_logfile):
+            os.remove(p_manger.stdout_logfile)
+        await p_manger.start()
+        await asyncio.sleep(1)
+        with open(p_manger.stdout_logfile, "rb") as f:
+            assert f.read() == b"line1\nline2"
+        # 按完整行转发 末尾不完整的行在EOF时转发
+        assert "[t_log_stream] line1" in caplog.text
+        assert "[t_log_stream] line2" in caplog.text
+        # 内存缓冲中的最近输出
+        assert p_manger.get_log_tail("out").tail(1) == b"line2"
+        assert p_manger.get_log_tail("err").end == 0
+        with pytest.raises(LogTypeError):
+            p_manger.get_log_tail("error_type")
+
+        caplog.clear()
+        p_manger = SubProcess(
+            Task(
+                name="t_log_stream", command=command, extra_json='{"log_mirror": false}'
+            )
+        )
+        await p_manger.start()
+        await asyncio.sleep(1)
+        with open(p_manger.stdout_logfile, "rb") as f:
+            assert f.read() == b"line1\nline2line1\nline2"
+        assert "[t_log_stream]" not in caplog.text
+
+    @pytest.mark.asyncio
+    async def test_log_direct(self, tmp_path):
+        command = f"{sys.executable} -c \"print('line1');print('line2',end='')\""
+        p_manger = SubProcess(
+            Task(
+                name="t_log_direct",
+                command=command,
+                stdout_logfile=str(tmp_path / "out.log"),
+                stderr_logfile=str(tmp_path / "err.log"),
+                extra_json='{"log_mode": "direct"}',
+            )
+        )
+        await p_manger.start()
+        # 子进程直接写入日志文件 daemon不读取输出
+        assert p_manger.process.stdout is None
+        await p_manger.process.wait()
+        with open(p_manger.stdout_logfile, "rb") as f:
+            assert f.read() == b"line1\nline2"
+        assert os.path.getsize(p_manger.stderr_logfile) == 0
+
+        with pytest.raises(RunError):
+            await SubProcess(
+                Task(name="t_log_mode", command=command, extra_json='{"log_mode": "x"}')
+            ).start()
+
+    @pytest.mark.asyncio
+    async def test_log_tail(self):
+        log_tail = LogTail(max_size=1024)
+        for i in range(200):
+            log_tail.append(b"line%03d\n" % i)
+        # 超出max_size的旧数据已丢弃
+        assert log_tail.start > 0
+        assert log_tail.tail(2) == b"line198\nline199\n"
+        assert log_tail.since(log_tail.end - 8) == b"line199\n"
+        assert log_tail.since(0) == log_tail.tail(1000)
+
+        follow = log_tail.follow(1)
+        assert await follow.__anext__() == b"line199\n"
+        next_data = asyncio.ensure_future(follow.__anext__())
+        await asyncio.sleep(0.01)
+        assert not next_data.done()
+        log_tail.append(b"new")
+        log_tail.append(b" line\n")
+        assert await asyncio.wait_for(next_data, 1) == b"new line\n"
+        await follow.aclose()
+
+    @pytest.mark.asyncio
+    async def test_log_records(self, tmp_path):
+        script = tmp_path / "print.py"
+        script.write_text(
+            "import time\n"
+            "for i in range(5):\n"
+            "    print(i, flush=True)\n"
+            "    time.sleep(0.1)\n"
+        )
+        extra = {
+            "log_format": "json",
+            "log_index_interval": 0.05,
+            "log_flush_interval": 0.01,
+            "log_buffer_size": 1,
+        }
+        p_manger = SubProcess(
+            Task(
+                name="t_log_records",
+                command=f"{sys.executable} {script}",
+                stdout_logfile=str(tmp_path / "out.log"),
+                extra_json=json.dumps(extra),
+            )
+        )
+        await p_manger.start()
+        await p_manger.process.wait()
+        await asyncio.sleep(0.1)
+        with open(p_manger.stdout_logfile, "rb") as f:
+            records = [json.loads(line) for line in f]
+        assert [record["line"] for record in records] == ["0", "1", "2", "3", "4"]
+        assert records[0]["task"] == "t_log_records"
+        assert records[0]["stream"] == "out"
+        assert records[0]["pid"] == p_manger.process.pid
+        # 按时间索引定位 该偏移量之前的记录都早于查询时间
+        assert os.path.getsize(p_manger.stdout_logfile + ".idx") >= 16 * 3
+        offset = find_offset(p_manger.stdout_logfile, records[3]["time"])
+        assert 0 < offset <= os.path.getsize(p_manger.stdout_logfile)
+        lines, _ = read_records(
+            p_manger.stdout_logfile, records[2]["time"], records[3]["time"]
+        )
+        assert [json.loads(line)["line"] for line in lines] == ["2", "3"]
+        lines, _ = read_records(p_manger.stdout_logfile, limit=2)
+        assert len(lines) == 2
+
+        with pytest.raises(RunError):
+            await SubProcess(
+                Task(
+                    name="t_log_format",
+                    command=f"{sys.executable} {script}",
+                    extra_json='{"log_format": "x"}',
+                )
+            ).start()
+
+    @pytest.mark.asyncio
+    async def test_log_overflow(self, tmp_path):
+        lines = [b"%07d\n" % i for i in range(10)]
+        for policy in OverflowPolicy:
+            path = str(tmp_path / f"{policy.value}.log")
+            log_file = LogFileBuffer(
+                path,
+                buffer_size=1,
+                flush_interval=0,
+                max_queue_size=16,
+                overflow=policy,
+            )
+            write = log_file._write
+            gate = threading.Event()
+            written = []
+
+            def _slow_write(data, write=write, gate=gate, written=written):
+                gate.wait()  # 模拟卡住的磁盘
+                written.append(data)
+                write(data)
+
+            log_file._write = _slow_write
+            if policy is OverflowPolicy.block:
+                threading.Timer(0.2, gate.set).start()
+            for line in lines:
+                await log_file.write(line)
+            # 写入返回时写线程是否已经落盘
+            waited = bool(written)
+            gate.set()
+            log_file.close()
+            await log_file.wait_closed()
+            with open(path, "rb") as f:
+                data = f.read()
+            if policy is OverflowPolicy.block:
+                # 等待写线程 不丢弃
+                assert waited
+                assert data == b"".join(lines) and log_file.dropped == 0
+                continue
+            # 写入不等待磁盘
+            assert not waited
+            assert log_file.dropped > 0
+            assert len(data) + log_file.dropped == len(b"".join(lines))
+            if policy is OverflowPolicy.drop_newest:
+                assert data.startswith(lines[0])
+            else:
+                assert data.endswith(lines[-1])
+
+    @pytest.mark.asyncio
+    async def test_log_rotate(self, tmp_path):
+        path = str(tmp_path / "out.log")
+        log_file = LogFileBuffer(
+            path, buffer_size=1, max_bytes=16, backup_count=2, compress=True
+        )
+        for i in range(5):
+            await log_file.write(b"line%05d\n" % i)
+            await asyncio.sleep(0.05)
+        log_file.close()
+        await log_file.wait_closed()
+        await asyncio.sleep(0.2)  # 等待压缩线程
+        with open(path, "rb") as f:
+            assert f.read() == b"line00004\n"
+        # 每次写入超过16字节时轮转 保留最近2个压缩后的轮转文件
+        backups = sorted(name for name in os.listdir(tmp_path) if name != "out.log")
+        assert len(backups) == 2
+        assert all(name.endswith(".gz") for name in backups)
+        with gzip.open(os.path.join(tmp_path, backups[-1])) as f:
+            assert f.read() == b"line00003\n"
+
+        # 按时间轮转 从文件开始写入时计算
+        path = str(tmp_path / "age.log")
+        log_file = LogFileBuffer(path, buffer_size=1, max_age=0.1, backup_count=5)
+        await log_file.write(b"first\n")
+        await asyncio.sleep(0.15)
+        await log_file.write(b"second\n")
+        log_file.close()
+        await log_file.wait_closed()
+        with open(path, "rb") as f:
+            assert f.read() == b"second\n"
+        assert len(os.listdir(tmp_path)) == 5
+        # 每次启动任务都新建LogFileBuffer 文件的写入时间不随之重置
+        for i in range(3):
+            log_file = LogFileBuffer(path, buffer_size=1, max_age=0.25, backup_count=5)
+            await log_file.write(b"run%d\n" % i)
+            log_file.close()
+            await log_file.wait_closed()
+            await asyncio.sleep(0.15)
+        with open(path, "rb") as f:
+            assert f.read() == b"run2\n"
+        backups = sorted(name for name in os.listdir(tmp_path) if "age.log." in name)
+        assert len(backups) == 2
+        with open(os.path.join(tmp_path, backups[-1]), "rb") as f:
+            assert f.read() == b"second\nrun0\nrun1\n"
+
+        # 索引文件被外部删除时仍能轮转 不丢弃写入
+        path = str(tmp_path / "idx.log")
+        log_file = LogFileBuffer(path, buffer_size=1, max_bytes=16, index_interval=1)
+        await log_file.write(b"line%05d\n" % 0)
+        await asyncio.sleep(0.05)
+        os.remove(path + ".idx")
+        await log_file.write(b"line%05d\n" % 1)
+        log_file.close()
+        await log_file.wait_closed()
+        with open(path, "rb") as f:
+            assert f.read() == b"line00001\n"
+
+    @pytest.mark.asyncio
+    async def test_directory(self, tmp_path):
+        cwd = os.getcwd()
+        p_manger = SubProcess(
+            Task(
+                name="t_directory",
+                command="pwd",
+                directory=str(tmp_path),
+                stdout_logfile=str(tmp_path / "out.log"),
+                extra_json='{"log_mode": "direct"}',
+            )
+        )
+        await p_manger.start()
+        await p_manger.process.wait()
+        # 只切换子进程的工作目录
+        assert os.getcwd() == cwd
+        with open(p_manger.stdout_logfile) as f:
+            assert f.read() == f"{tmp_path}\n"
+
+    @pytest.mark.asyncio
+    async def test_spawn_backend(self, tmp_path):
+        command = f"{sys.executable} -c \"print('line1');exit(3)\""
+        p_manger = SubProcess(
+            Task(
+                name="t_posix_spawn",
+                command=command,
+                stdout_logfile=str(tmp_path / "out.log"),
+                extra_json='{"spawn_backend": "posix_spawn"}',
+            )
+        )
+        await p_manger.start()
+        assert isinstance(p_manger.process, spawn.SpawnedProcess)
+        assert await p_manger._watcher_task == 3
+        assert p_manger.state is ProcessStatus.exit_error
+        await asyncio.sleep(0.1)
+        with open(p_manger.stdout_logfile, "rb") as f:
+            assert f.read() == b"line1\n"
+
+        p_manger = SubProcess(
+            Task(
+                name="t_posix_spawn_stop",
+                command="sleep 10",
+                extra_json='{"spawn_backend": "posix_spawn"}',
+            )
+        )
+        await p_manger.start()
+        assert p_manger.is_running()
+        await p_manger.stop()
+        assert await asyncio.wait_for(p_manger.process.wait(), 1) < 0
+        assert not p_manger.is_running()
+
+        # 进程已被其他地方回收时 退出码未知
+        process = await spawn.posix_spawn_exec(
+            sys.executable, "-c", "pass", env={}, stdout=None, stderr=None
+        )
+        os.waitpid(process.pid, 0)
+        assert await asyncio.wait_for(process.wait(), 1) == -1
+        assert process._reap() == -1  # 等待线程同样使用_reap
+
+        # posix_spawn 不能切换工作目录 添加任务时报错
+        with pytest.raises(RunError):
+            SubProcess(
+                Task(
+                    name="t_posix_spawn_cwd",
+                    command="pwd",
+                    directory=str(tmp_path),
+                    extra_json='{"spawn_backend": "posix_spawn"}',
+                )
+            )
+        with pytest.raises(RunError):
+            await SubProcess(
+                Task(
+                    name="t_spawn_backend",
+                    command=command,
+                    extra_json='{"spawn_backend": "x"}',
+                )
+            ).start()
+
+    @pytest.mark.skipif(
+        not os.environ.get("LK_FLOW_BENCHMARK"), reason="设置LK_FLOW_BENCHMARK=1时运行"
+    )
+    def test_spawn_benchmark(self, benchmark, tmp_path):
+        def _latency(backend: str) -> float:
+            p_manger = SubProcess(
+                Task(
+                    name=f"t_spawn_{backend}",
+                    command="/usr/bin/true",
+                    stdout_logfile=str(tmp_path / "out.log"),
+                    stderr_logfile=str(tmp_path / "err.log"),
+                    extra_json=f'{{"spawn_backend": "{backend}", "log_mode": "direct"}}',
+                )
+            )
+
+            async def _start():
+                await p_manger.start()
+                await p_manger.process.wait()
+                return p_manger.start_latency
+
+            latency = [loop.run_until_complete(_start()) for _ in range(20)]
+            return sorted(latency)[len(latency) // 2]
+
+        # 模拟内存占用较大的daemon 页面需实际写入
+        ballast = bytearray(200 * 2**20)
+        for i in range(0, len(ballast), 4096):
+            ballast[i] = 1
+        loop = asyncio.new_event_loop()
+        try:
+            asyncio_latency = _latency("asyncio")
+            posix_spawn_latency = benchmark(_latency, "posix_spawn")
+        finally:
+            loop.close()
+        benchmark.extra_info["rss_kb"] = resource.getrusage(
+            resource.RUSAGE_SELF
+        ).ru_maxrss
+        benchmark.extra_info["asyncio_latency"] = asyncio_latency
+        benchmark.extra_info["posix_spawn_latency"] = posix_spawn_latency
+        del ballast
+
+    def test_parse_command(self, tmp_path):
+        p_manger = SubProcess(
+            Task(name="t_parse", command='/usr/bin/echo "this is a echo message"')
+        )
+        assert p_manger._prepare_start()[:2] == (
+            "/usr/bin/echo",
+            ["this is a echo message"],
+        )
+        # 在任务环境变量的PATH中查找
+        tool = tmp_path / "t_tool"
+        tool.write_text("#!/bin/sh\n")
+        tool.chmod(0o755)
+        p_manger = SubProcess(
+            Task(name="t_path", command="t_tool -v", environment=f"PATH={tmp_path}")
+        )
+        assert p_manger._prepare_start()[:2] == (str(tool), ["-v"])
+        # 相对路径相对于工作目录
+        p_manger = SubProcess(
+            Task(name="t_relative", command="./t_tool", directory=str(tmp_path))
+        )
+        assert p_manger._prepare_start()[0] == str(tool)
+
+        # 命令错误在添加任务时抛出
+        context = Context.get_instance()
+        for command in ('echo "unclosed', "t_tool", "./t_missing"):
+            with pytest.raises(RunError):
+                context.add_task(Task(name="t_bad_command", command=command))
+        assert "t_bad_command" not in dict(context.get_all_processes())
+
+    def test_prepare_start_cache(self, benchmark, tmp_path):
+        script = tmp_path / "run.sh"
+        script.write_text("#!/bin/sh\n")
+        p_manger = SubProcess(
+            Task(
+                name="t_prepare",
+                command=f"{script} -a",
+                environment="A=1;B=2",
+            )
+        )
+        filename, argv, env = p_manger._prepare_start()
+        assert (filename, argv, env["A"]) == (str(script), ["-a"], "1")
+
+        def _uncached():
+            p_manger._start_cache = None
+            return p_manger._prepare_start()
+
+        start_time = time.perf_counter()
+        for _ in range(1000):
+            _uncached()
+        uncached_time = (time.perf_counter() - start_time) / 1000
+        p_manger._prepare_start()
+        # 命中缓存时只比较配置与可执行文件的mtime
+        result = benchmark(p_manger._prepare_start)
+        assert result == (filename, argv, env)
+        benchmark.extra_info["uncached"] = uncached_time
+
+        # 配置变化 或可执行文件被修改时重新解析
+        p_manger.config.environment = "A=3"
+        assert p_manger._prepare_start()[2]["A"] == "3"
+        cached_env = p_manger._prepare_start()[2]
+        assert p_manger._prepare_start()[2] is cached_env
+        # env是daemon环境变量的快照 配置不变时不重新读取
+        os.environ["T_LK_FLOW_SNAPSHOT"] = "1"
+        try:
+            assert "T_LK_FLOW_SNAPSHOT" not in p_manger._prepare_start()[2]
+        finally:
+            del os.environ["T_LK_FLOW_SNAPSHOT"]
+        os.utime(script, ns=(0, 0))
+        assert p_manger._prepare_start()[2] is not cached_env
+        os.remove(script)
+        with pytest.raises(RunError):
+            p_manger._prepare_start()
+
+    def test_log_stream_benchmark(self, benchmark, tmp_path):
+        p_manger = SubProcess(
+            Task(
+                name="t_log_benchmark",
+                command="/usr/bin/true",
+                stdout_logfile=str(tmp_path / "out.log"),
+                extra_json='{"log_mirror": false}',
+            )
+        )
+        chunk = (b"x" * 79 + b"\n") * 800
+        rounds = 64
+
+        async def _pipe():
+            stream = asyncio.StreamReader()
+            for _ in range(rounds):
+                stream.feed_data(chunk)
+            stream.feed_eof()
+            await p_manger._handle_log_stream(
+                logging.INFO, stream, p_manger.stdout_logfile
+            )
+
+        loop = asyncio.new_event_loop()
+        try:
+            # 单个子进程 4MB/51200行输出的处理耗时
+            benchmark(lambda: loop.run_until_complete(_pipe()))
+        finally:
+            loop.close()
+        benchmark.extra_info["lines"] = 800 * rounds
+        assert os.path.getsize(p_manger.stdout_logfile) % len(chunk) == 0
+
 
 if __name__ == "__main__":
     loop = asyncio.get_event_loop()